@@ -0,0 +1,149 @@
+"""
+Interface en ligne de commande.
+
+Usage : python -m projet_clauverj_sthoby [options] -o OBJECTIF CONSTANTE...
+        python -m projet_clauverj_sthoby [options] < jeux.jsonl
+
+Sans constantes en argument, chaque ligne de l'entrée standard est un jeu au format JSON,
+par exemple {"numbers": [8, 10, 2, 1, 5, 50], "objective": 899}, dont les champs approx,
+no_overflow, bits, backend et timeout remplacent les options. Chaque réponse est écrite sur une
+ligne JSON (champ status : sat, unsat, timeout ou error, comme pour service.py).
+
+Z3 (avec chiffres et model_checker) n'est importé qu'au premier jeu qui doit être résolu par
+un backend qui l'utilise : les jeux auxquels répondent le cache, les filtres de presolve
+ou la recherche directe (--backend search) n'en paient pas le coût. Avec --timings, les durées
+d'import sont écrites sur la sortie d'erreur.
+"""
+from time import time
+
+_begin = time()
+
+import argparse
+import json
+import os
+import sys
+from typing import Dict, Optional
+
+# les modules du projet s'importent les uns les autres par leur nom (from chiffres import ...),
+# comme lorsqu'ils sont lancés depuis ce répertoire. Seule l'interface en ligne de commande
+# place donc ce répertoire en tête de sys.path : importer le paquet ne modifie pas sys.path.
+_directory = os.path.dirname(os.path.abspath(__file__))
+if _directory not in sys.path:
+    sys.path.insert(0, _directory)
+
+from cache import SolutionCache
+from presolve import apply_filters
+from search import GameInput, SearchSolution, check_bits, portable_solution, search
+
+# durées d'import en secondes
+timings = {"startup": time() - _begin}
+
+
+def _solve_with_z3(input: GameInput, approx: bool, no_overflow: bool, bits, backend: str,
+                   timeout: Optional[float]) -> Optional[SearchSolution]:
+    begin = time()
+    from chiffres import solve
+    timings.setdefault("z3", time() - begin)
+    return portable_solution(solve(input, approx=approx, no_overflow=no_overflow, bits=bits,
+                                   backend=backend, timeout=timeout), input, no_overflow, bits)
+
+
+def answer(input: GameInput, approx: bool, no_overflow: bool, bits, backend: str,
+           timeout: Optional[float], cache: Optional[SolutionCache] = None
+           ) -> Optional[SearchSolution]:
+    """
+    Résout un jeu comme chiffres.solve, sans importer Z3 lorsque le cache, les filtres ou la
+    recherche directe suffisent
+    :param bits: nombre de bits ou "auto" (voir solve)
+    """
+    if cache is not None:
+        hit, solution = cache.get(input, approx, no_overflow, bits)
+        if hit:
+            return solution
+    check_bits(input.numbers, [input.objective], bits)
+    decided, solution = False, None
+    if bits != "auto":
+        filters = apply_filters(input, approx, no_overflow, bits, beam_width=0)
+        decided, solution = filters.decided, filters.solution
+        if not decided and backend == "search":
+            decided, solution = True, search(input.numbers, input.objective, approx,
+                                             no_overflow, bits, timeout)
+    if not decided:
+        solution = _solve_with_z3(input, approx, no_overflow, bits, backend, timeout)
+    if cache is not None:
+        cache.put(input, approx, no_overflow, bits, solution)
+    return solution
+
+
+def handle(request: Dict, defaults: Dict, cache: Optional[SolutionCache] = None) -> Dict:
+    """
+    Traite un jeu (les champs absents de request sont pris dans defaults)
+    :return: la réponse, au format de service.handle
+    """
+    begin = time()
+    options = {**defaults, **{key: value for key, value in request.items() if key in defaults}}
+    response = {"id": request.get("id")}
+    try:
+        input = GameInput(numbers=[int(number) for number in request["numbers"]],
+                          objective=int(request["objective"]))
+        bits = options["bits"] if options["bits"] == "auto" else int(options["bits"])
+        solution = answer(input, bool(options["approx"]), bool(options["no_overflow"]), bits,
+                          options["backend"], options["timeout"], cache)
+        if solution is None:
+            response["status"] = "unsat"
+        else:
+            response.update(status="sat", result=solution.resulting_number(),
+                            difference=solution.difference, actions=solution.actions)
+    except TimeoutError:
+        response["status"] = "timeout"
+    except Exception as e:
+        response.update(status="error", error=f"{type(e).__name__}: {e}")
+    response["elapsed"] = time() - begin
+    return response
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog="python -m projet_clauverj_sthoby", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("numbers", nargs="*", type=int, help="les constantes du jeu")
+    parser.add_argument("-o", "--objective", type=int)
+    parser.add_argument("--approx", action="store_true")
+    parser.add_argument("--overflow", action="store_true", help="autorise les dépassements")
+    parser.add_argument("--bits", default="14", help='nombre de bits ou "auto"')
+    parser.add_argument("--backend", default="smt")
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--cache", metavar="PATH", help="base SQLite du cache des solutions")
+    parser.add_argument("--timings", action="store_true",
+                        help="écrit les durées d'import sur la sortie d'erreur")
+    args = parser.parse_args(arguments)
+    if args.numbers and args.objective is None:
+        parser.error("l'objectif (-o) est nécessaire avec des constantes en argument")
+
+    defaults = {"approx": args.approx, "no_overflow": not args.overflow, "bits": args.bits,
+                "backend": args.backend, "timeout": args.timeout}
+    cache = None if args.cache is None else SolutionCache(path=args.cache)
+    try:
+        if args.numbers:
+            lines = [json.dumps({"numbers": args.numbers, "objective": args.objective})]
+        else:
+            lines = sys.stdin
+        for line in lines:
+            if not line.strip():
+                continue
+            # comme service.serve_stdin, une ligne invalide n'arrête pas les suivantes
+            try:
+                response = handle(json.loads(line), defaults, cache)
+            except json.JSONDecodeError as e:
+                response = {"id": None, "status": "error", "error": f"JSONDecodeError: {e}"}
+            print(json.dumps(response), flush=True)
+    finally:
+        if cache is not None:
+            cache.close()
+    if args.timings:
+        print(f"Import : {1000 * timings['startup']:.1f} ms, Z3 et chiffres : "
+              + (f"{1000 * timings['z3']:.1f} ms" if "z3" in timings else "non importés"),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
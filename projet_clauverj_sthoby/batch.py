@@ -0,0 +1,89 @@
+"""
+Résolution d'un grand nombre de jeux sur un pool de processus.
+
+Chaque processus du pool garde son propre contexte Z3 (le contexte par défaut du
+processus) pendant toute la durée du lot : Z3 n'est importé et initialisé qu'une fois
+par processus et non une fois par jeu.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from time import time
+from typing import Iterable, Iterator, Optional
+
+from chiffres import GameInput, solve
+from search import SearchSolution, portable_solution
+
+
+@dataclass
+class BatchResult:
+    """
+    Résultat de la résolution d'un jeu du lot
+    :param index: position du jeu dans la liste des entrées
+    :param input: le jeu
+    :param solution: la solution (séquence d'actions et piles) ou None s'il n'y en a pas
+    :param error: le message de l'exception levée lors de la résolution, None sinon
+    :param elapsed: durée de la résolution en secondes
+    """
+    index: int
+    input: GameInput
+    solution: Optional[SearchSolution]
+    error: Optional[str]
+    elapsed: float
+
+
+def _solve_one(index: int, input: GameInput, approx: bool, no_overflow: bool, bits: int,
+               backend: str, timeout: Optional[float]) -> BatchResult:
+    begin = time()
+    try:
+        solution = solve(input, approx=approx, no_overflow=no_overflow, bits=bits,
+                         backend=backend, timeout=timeout)
+        return BatchResult(index, input, portable_solution(solution, input, no_overflow, bits),
+                           None, time() - begin)
+    except Exception as e:
+        return BatchResult(index, input, None, f"{type(e).__name__}: {e}", time() - begin)
+
+
+def solve_many(inputs: Iterable[GameInput], approx: bool, no_overflow: bool, bits: int,
+               workers: Optional[int] = None, backend: str = "smt",
+               timeout: Optional[float] = None) -> Iterator[BatchResult]:
+    """
+    Résout une liste de jeux en parallèle. Les résultats sont produits dans l'ordre
+    où les résolutions se terminent (utiliser BatchResult.index pour les réordonner).
+    Une erreur ou un dépassement de temps sur un jeu est reporté dans son BatchResult
+    sans interrompre le lot.
+    :param inputs: les jeux à résoudre
+    :param approx: voir solve
+    :param no_overflow: voir solve
+    :param bits: voir solve
+    :param workers: nombre de processus (par défaut le nombre de coeurs)
+    :param backend: voir solve
+    :param timeout: Durée maximale de résolution d'un jeu en secondes
+    :return: un itérateur de BatchResult
+    """
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # on ne soumet qu'un nombre limité de jeux à la fois pour ne pas garder
+        # en mémoire des milliers de futures
+        window = 2 * workers
+        pending = set()
+        for index, input in enumerate(inputs):
+            pending.add(executor.submit(_solve_one, index, input, approx, no_overflow, bits,
+                                        backend, timeout))
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from (future.result() for future in done)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from (future.result() for future in done)
+
+
+if __name__ == '__main__':
+    import games
+
+    all_games = [value for name, value in vars(games).items() if isinstance(value, GameInput)]
+    begin = time()
+    for result in solve_many(all_games, approx=False, no_overflow=True, bits=14, timeout=60):
+        print(result.input.objective, result.error or result.solution and result.solution.actions,
+              f"{result.elapsed:.2f}s")
+    print("Time to solve : ", time() - begin, "s")
@@ -0,0 +1,223 @@
+"""
+Suite de benchmarks de solve (bmc, bmc_approx) sur les jeux de games.py et sur un corpus
+de jeux générés aléatoirement, en résolution exacte et approchée, avec et sans dépassements.
+
+Pour chaque résolution on enregistre la durée totale, la durée de chaque profondeur du
+bounded model checking, les statistiques de Z3 (conflits, décisions, mémoire...) et la taille
+de la formule. La sortie est un document JSON, à comparer à une exécution précédente avec
+--baseline pour repérer les régressions.
+
+Avec --profile, la durée est de plus répartie entre la construction des formules en Python
+et les appels à solver.check(), et les fonctions Python les plus coûteuses sont relevées.
+
+La durée de construction des formules (hors appels à check()) est relevée pour chaque
+résolution. Les formules des transitions sont réutilisées d'un jeu à l'autre lorsque le nombre
+de constantes et la largeur sont les mêmes ; avec --cold elles sont reconstruites à chaque
+résolution, ce qui permet de mesurer le gain.
+
+Usage : python3 benchmark.py [--random 20] [--tiles 4 6] [--bits 10 14] [--modes exact approx]
+    [--overflow both] [--encoding registers] [--timeout 60] [--profile] [--cold]
+    [--output run.json] [--baseline previous.json]
+"""
+import argparse
+import cProfile
+import json
+import pstats
+import random
+import sys
+from dataclasses import asdict
+from time import time
+from typing import Dict, List
+
+from z3 import Solver
+
+import games
+from chiffres import GameInput, solve, solution_resulting_number, _default_template
+from model_checker import Counters, DepthEvent
+from reachability import STANDARD_TILES
+
+# statistiques de Z3 reprises dans le rapport (quand le solveur les fournit)
+STATISTICS = ("conflicts", "decisions", "propagations", "memory", "max memory", "num allocs")
+
+
+def statistics(values: Dict[str, float]) -> Dict[str, float]:
+    return {key: value for key, value in values.items() if key in STATISTICS}
+
+
+def depth_record(event: DepthEvent) -> Dict:
+    return {"depth": event.depth, "status": event.status, "time": event.duration,
+            "checks": event.checks, "assertions": event.assertions,
+            "best_score": event.best_score, **statistics(event.statistics)}
+
+
+def formula_size(solver) -> Dict[str, int]:
+    """
+    Nombre d'assertions du solveur et nombre de noeuds distincts de leur DAG
+    """
+    assertions = solver.assertions()
+    seen = set()
+    todo = list(assertions)
+    while todo:
+        expression = todo.pop()
+        if expression.get_id() in seen:
+            continue
+        seen.add(expression.get_id())
+        todo.extend(expression.children())
+    return {"assertions": len(assertions), "ast_nodes": len(seen)}
+
+
+def generated_games(count: int, tiles: List[int], bits: List[int], seed: int):
+    """
+    Jeux aléatoires : des plaques du jeu télévisé et un objectif entre 100 et 999
+    (bornés par la largeur des entiers)
+    :return: des couples (nom, jeu, bits)
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        for nb_tiles in tiles:
+            for width in bits:
+                available = [tile for tile in STANDARD_TILES if tile.bit_length() <= width]
+                numbers = rng.sample(available, min(nb_tiles, len(available)))
+                objective = rng.randint(min(100, (1 << width) - 1), min(999, (1 << width) - 1))
+                yield f"random{i}-{nb_tiles}x{width}", GameInput(numbers, objective), width
+
+
+def run(name: str, game: GameInput, approx: bool, no_overflow: bool, bits: int, args) -> Dict:
+    result = {
+        "name": name, "numbers": game.numbers, "objective": game.objective,
+        "approx": approx, "no_overflow": no_overflow, "bits": bits,
+    }
+    solvers, events, counters = [], [], Counters()
+
+    def mk_solver():
+        solvers.append(Solver())
+        return solvers[-1]
+
+    if args.cold:
+        _default_template.cache_clear()
+    profiler = cProfile.Profile() if args.profile else None
+    begin = time()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        solution = solve(game, approx=approx, no_overflow=no_overflow, bits=bits,
+                         backend=args.backend, timeout=args.timeout, mk_solver=mk_solver,
+                         encoding=args.encoding, symmetry=args.symmetry, engine=args.engine,
+                         observer=events.append, counters=counters)
+        result["status"] = "unsat" if solution is None else "sat"
+        if solution is not None:
+            result["result"] = int(str(solution_resulting_number(solution)))
+            result["difference"] = int(str(solution.difference))
+            result["length"] = len(list(solution.actions_effectuees()))
+    except TimeoutError:
+        result["status"] = "timeout"
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    result["wall"] = time() - begin
+
+    if solvers:
+        result["depths"] = [depth_record(event) for event in events]
+        result["counters"] = asdict(counters)
+        result["construction"] = counters.total_time - counters.check_time
+        result["statistics"] = statistics(events[-1].statistics) if events else {}
+        result["formula"] = formula_size(solvers[-1])
+    if profiler is not None:
+        check_time = counters.check_time
+        stats = pstats.Stats(profiler)
+        # fonctions triées par durée propre (hors fonctions appelées)
+        top = sorted(([f"{function[0]}:{function[1]}({function[2]})", own, cumulative]
+                      for function, (_, _, own, cumulative, _) in stats.stats.items()),
+                     key=lambda item: -item[1])
+        result["profile"] = {
+            "check": check_time,
+            "construction": result["wall"] - check_time,
+            "top": top[:args.profile_top],
+        }
+    return result
+
+
+def compare(runs: List[Dict], baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Compare les résolutions à celles d'une exécution précédente
+    :return: les régressions (durée ou statut)
+    """
+    key = lambda run: (run["name"], run["approx"], run["no_overflow"], run["bits"])
+    previous = {key(run): run for run in baseline["runs"]}
+    regressions = []
+    for run in runs:
+        before = previous.get(key(run))
+        if before is None:
+            continue
+        if before["status"] != run["status"]:
+            regressions.append(f"{key(run)} : {before['status']} -> {run['status']}")
+        elif run["wall"] > before["wall"] * (1 + tolerance) and run["wall"] - before["wall"] > 0.1:
+            regressions.append(f"{key(run)} : {before['wall']:.2f}s -> {run['wall']:.2f}s")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--no-games", action="store_true", help="ignore les jeux de games.py")
+    parser.add_argument("--random", type=int, default=0, help="nombre de jeux générés")
+    parser.add_argument("--tiles", type=int, nargs="+", default=[6],
+                        help="nombres de plaques des jeux générés")
+    parser.add_argument("--bits", type=int, nargs="+", default=[14])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="+", default=["exact", "approx"],
+                        choices=("exact", "approx"))
+    parser.add_argument("--overflow", default="forbidden", choices=("forbidden", "allowed", "both"),
+                        help="dépassements d'entiers")
+    parser.add_argument("--backend", default="smt", choices=("smt", "search"))
+    parser.add_argument("--encoding", default="array", choices=("array", "registers"))
+    parser.add_argument("--engine", default="incremental", choices=("incremental", "single"))
+    parser.add_argument("--symmetry", action="store_true")
+    parser.add_argument("--timeout", type=float, default=60, help="en secondes, par résolution")
+    parser.add_argument("--cold", action="store_true",
+                        help="reconstruit les formules des transitions à chaque résolution")
+    parser.add_argument("--profile", action="store_true",
+                        help="sépare construction des formules et appels à check()")
+    parser.add_argument("--profile-top", type=int, default=15)
+    parser.add_argument("--output", help="fichier JSON (sortie standard par défaut)")
+    parser.add_argument("--baseline", help="fichier JSON d'une exécution précédente")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="ralentissement relatif toléré par rapport à --baseline")
+    args = parser.parse_args()
+
+    instances = []
+    if not args.no_games:
+        instances += [(name, game, bits) for name, game in vars(games).items()
+                      if isinstance(game, GameInput) for bits in args.bits]
+    instances += list(generated_games(args.random, args.tiles, args.bits, args.seed))
+    no_overflows = {"forbidden": [True], "allowed": [False], "both": [True, False]}[args.overflow]
+
+    runs = []
+    for name, game, bits in instances:
+        if any(number.bit_length() > bits for number in game.numbers + [game.objective]):
+            continue
+        for mode in args.modes:
+            for no_overflow in no_overflows:
+                runs.append(run(name, game, mode == "approx", no_overflow, bits, args))
+                print(f"{name} {mode} no_overflow={no_overflow} bits={bits} : "
+                      f"{runs[-1]['status']} {runs[-1]['wall']:.2f}s "
+                      f"(construction {runs[-1].get('construction', 0):.3f}s)",
+                      file=sys.stderr, flush=True)
+
+    report = {"config": {key: value for key, value in vars(args).items()
+                         if key not in ("output", "baseline")},
+              "runs": runs}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(runs, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("Régression", regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,41 @@
+"""
+Compare les temps de résolution de l'encodage de la pile par tableau Z3 ("array")
+et par registres ("registers") sur tous les jeux de games.py.
+
+Usage : python3 benchmark_encodings.py [--approx] [--symmetry] [--bits 14] [--timeout 120]
+"""
+import argparse
+from time import time
+
+import games
+from chiffres import GameInput, solve, solution_resulting_number
+
+ENCODINGS = ("array", "registers")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--approx", action="store_true", help="résolution approchée")
+    parser.add_argument("--overflow", action="store_true", help="autorise les dépassements")
+    parser.add_argument("--symmetry", action="store_true",
+                        help="ajoute les contraintes de symmetry_breaking")
+    parser.add_argument("--bits", type=int, default=14)
+    parser.add_argument("--timeout", type=float, default=120, help="en secondes, par résolution")
+    args = parser.parse_args()
+
+    print(f"{'jeu':<10}" + "".join(f"{encoding:>14}" for encoding in ENCODINGS) + "   résultat")
+    for name, game in vars(games).items():
+        if not isinstance(game, GameInput):
+            continue
+        times = []
+        results = set()
+        for encoding in ENCODINGS:
+            begin = time()
+            try:
+                solution = solve(game, approx=args.approx, no_overflow=not args.overflow,
+                                 bits=args.bits, encoding=encoding, symmetry=args.symmetry,
+                                 timeout=args.timeout)
+                times.append(f"{time() - begin:>13.2f}s")
+                results.add(None if solution is None else solution_resulting_number(solution).as_long())
+            except TimeoutError:
+                times.append(f"{'timeout':>14}")
+        print(f"{name:<10}" + "".join(times) + f"   {', '.join(map(str, results))}", flush=True)
@@ -0,0 +1,50 @@
+"""
+Compare les temps de résolution du moteur incrémental (un appel au solveur par profondeur)
+et du moteur en une seule requête (engine="single") sur les cas de test_chiffres.py.
+
+Usage : python3 benchmark_engines.py [--encoding array|registers] [--timeout 300]
+"""
+import argparse
+from time import time
+
+from chiffres import solve
+from games import *
+
+ENGINES = ("incremental", "single")
+
+# (nom, jeu, approx, bits, no_overflow) : les appels à solve de test_chiffres.py
+CASES = [
+    ("exact", game1_1, False, 8, False),
+    ("exact2", game1_2, False, 8, False),
+    ("exact3", game1_1, False, 14, False),
+    ("exact4", game1_2, False, 14, False),
+    ("exact5/game2", game2, False, 14, True),
+    ("exact5/game3_1", game3_1, False, 10, True),
+    ("exact5/game3_2", game3_2, False, 10, True),
+    ("exact5/game4", game4, False, 10, True),
+    ("approx/game1_2", game1_2, True, 14, True),
+    ("approx/game2", game2, True, 14, True),
+]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--encoding", default="array", choices=("array", "registers"))
+    parser.add_argument("--timeout", type=float, default=300, help="en secondes, par résolution")
+    args = parser.parse_args()
+
+    print(f"{'cas':<16}" + "".join(f"{engine:>14}" for engine in ENGINES))
+    totals = dict.fromkeys(ENGINES, 0.0)
+    for name, game, approx, bits, no_overflow in CASES:
+        times = []
+        for engine in ENGINES:
+            begin = time()
+            try:
+                solve(game, approx=approx, no_overflow=no_overflow, bits=bits, engine=engine,
+                      encoding=args.encoding, timeout=args.timeout)
+                totals[engine] += time() - begin
+                times.append(f"{time() - begin:>13.2f}s")
+            except TimeoutError:
+                totals[engine] += args.timeout
+                times.append(f"{'timeout':>14}")
+        print(f"{name:<16}" + "".join(times), flush=True)
+    print(f"{'total':<16}" + "".join(f"{totals[engine]:>13.2f}s" for engine in ENGINES))
@@ -0,0 +1,166 @@
+"""
+Cache des résultats de solve.
+
+Une instance est identifiée par (constantes triées, objectif, approx, no_overflow, bits) :
+l'ordre des constantes ne change pas la réponse. On ne stocke pas le modèle Z3 mais la
+séquence d'actions, les indices des push étant exprimés dans l'ordre trié des constantes,
+et l'écart à l'objectif. À la lecture les indices sont renumérotés dans l'ordre des
+constantes du jeu demandé et les piles sont recalculées en rejouant les actions.
+
+Le cache garde les entrées les plus récemment utilisées en mémoire (LRU) et peut
+les conserver sur disque dans une base SQLite, elle aussi bornée en taille.
+"""
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import time
+from typing import List, Optional, Tuple
+
+from search import SearchSolution, portable_solution, replay, replay_bits
+
+# marque l'absence de solution (problème insatisfiable), qui est aussi mise en cache
+_NO_SOLUTION = "null"
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    disk_hits: int = 0
+    disk_evictions: int = 0
+
+
+def _sorted_indices(numbers: List[int]) -> List[int]:
+    """
+    Indices des constantes dans l'ordre croissant de leurs valeurs
+    """
+    return sorted(range(len(numbers)), key=lambda i: numbers[i])
+
+
+def _renumber(actions: List[str], mapping: List[int]) -> List[str]:
+    return [f"push_{mapping[int(action[len('push_'):])]}" if action.startswith("push_")
+            else action for action in actions]
+
+
+class SolutionCache:
+    """
+    Cache des solutions indexé par instance canonique
+    :param maxsize: nombre maximal d'entrées gardées en mémoire
+    :param path: chemin de la base SQLite, None pour un cache uniquement en mémoire
+    :param max_disk_entries: nombre maximal d'entrées de la base, les moins récemment
+    utilisées sont supprimées au-delà
+    """
+
+    def __init__(self, maxsize: int = 4096, path: Optional[str] = None,
+                 max_disk_entries: int = 1_000_000):
+        self.maxsize = maxsize
+        self.max_disk_entries = max_disk_entries
+        self.stats = CacheStats()
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS solutions "
+                             "(key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS solutions_last_used "
+                             "ON solutions (last_used)")
+            self._db.commit()
+
+    @staticmethod
+    def key(input, approx: bool, no_overflow: bool, bits: int) -> str:
+        return json.dumps([sorted(input.numbers), input.objective, approx, no_overflow, bits])
+
+    def __len__(self):
+        return len(self._memory)
+
+    def get(self, input, approx: bool, no_overflow: bool, bits: int
+            ) -> Tuple[bool, Optional[SearchSolution]]:
+        """
+        :return: (True, solution) si l'instance est dans le cache (solution pouvant valoir
+        None si le problème est insatisfiable), (False, None) sinon
+        """
+        key = self.key(input, approx, no_overflow, bits)
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute("SELECT value FROM solutions WHERE key = ?",
+                                       (key,)).fetchone()
+                if row is not None:
+                    value = row[0]
+                    self.stats.disk_hits += 1
+                    self._db.execute("UPDATE solutions SET last_used = ? WHERE key = ?",
+                                     (time(), key))
+                    self._db.commit()
+                    self._remember(key, value)
+            if value is None:
+                self.stats.misses += 1
+                return False, None
+            self.stats.hits += 1
+        if value == _NO_SOLUTION:
+            return True, None
+        record = json.loads(value)
+        actions = _renumber(record["actions"], _sorted_indices(input.numbers))
+        return True, SearchSolution(
+            actions=actions,
+            stacks=replay(input.numbers, actions, replay_bits(input, bits), no_overflow),
+            difference=record["difference"],
+        )
+
+    def put(self, input, approx: bool, no_overflow: bool, bits: int,
+            solution: Optional[SearchSolution]):
+        key = self.key(input, approx, no_overflow, bits)
+        if solution is None:
+            value = _NO_SOLUTION
+        else:
+            # indice d'origine -> rang dans l'ordre trié
+            rank = [0] * len(input.numbers)
+            for position, i in enumerate(_sorted_indices(input.numbers)):
+                rank[i] = position
+            value = json.dumps({"actions": _renumber(solution.actions, rank),
+                                "difference": solution.difference})
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO solutions VALUES (?, ?, ?)",
+                                 (key, value, time()))
+                excess = self._db.execute("SELECT COUNT(*) FROM solutions"
+                                          ).fetchone()[0] - self.max_disk_entries
+                if excess > 0:
+                    self._db.execute("DELETE FROM solutions WHERE key IN (SELECT key FROM "
+                                     "solutions ORDER BY last_used LIMIT ?)", (excess,))
+                    self.stats.disk_evictions += excess
+                self._db.commit()
+
+    def _remember(self, key: str, value: str):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+            self.stats.evictions += 1
+
+    def solve(self, input, approx: bool, no_overflow: bool, bits: int, **solve_kwargs
+              ) -> Optional[SearchSolution]:
+        """
+        Comme chiffres.solve (dont les autres paramètres sont acceptés) mais en consultant
+        d'abord le cache. Renvoie toujours une solution sans référence à Z3.
+        """
+        hit, solution = self.get(input, approx, no_overflow, bits)
+        if hit:
+            return solution
+        from chiffres import solve
+        solution = portable_solution(
+            solve(input, approx=approx, no_overflow=no_overflow, bits=bits, **solve_kwargs),
+            input, no_overflow, bits)
+        self.put(input, approx, no_overflow, bits, solution)
+        return solution
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -3,29 +3,26 @@ import sys
 
 #logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 from dataclasses import dataclass
-from typing import List, Optional
-from model_checker import bmc, bmc_approx, Solution
-from uuid import uuid4
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from model_checker import bmc, bmc_approx, bmc_approx_iter, bmc_single, bmc_approx_single, \
+    bmc_all, bmc_values, Counters, DepthEvent, Interrupt, Solution, Unrolling
+from search import search, distance, replay, canonical_expression, check_bits, countdown, \
+    safe_bits, GameInput, SearchSolution
+from presolve import Presolve, apply_filters, beam
 from z3 import *
+# après z3, qui définit aussi Union
+from typing import Union
 from time import time
-from functools import partial
+from functools import lru_cache, partial
 
 
 
-@dataclass
-class GameInput:
-    """
-    Description du problème
-    :example: GameInput(numbers= [8, 10, 2, 1, 5, 50], objective=899)
-    """
-    numbers: List[int]
-    objective: int
-
-def mk_State(numbers: List[int], bits: int):
+def mk_State(numbers: List[int], bits: int, ctx: Optional[Context] = None):
     """
     Retourne une classe State qui représente un état du modèle à vérifier
     :param numbers: la liste des constantes entières c_1, ..., c_N
     :param bits: le nombre de bits des bits vecteurs utilisés
+    :param ctx: le contexte Z3 des variables (None pour le contexte par défaut)
     :return: Une classe qui modèle un état
     """
     @dataclass
@@ -41,10 +38,87 @@ def mk_State(numbers: List[int], bits: int):
         stack: z3.ArrayRef
         numbers_used: List[z3.BoolRef]
 
-        def __init__(self, i):
-            self.index = Int(f"index[{i}]")
-            self.stack = Array(f"stack[{i}]", IntSort(), BitVecSort(bits))
-            self.numbers_used = [Bool(f"used[{i}]({n})") for n, _ in enumerate(numbers)]
+        def __init__(self, i, numbers=numbers):
+            """
+            :param numbers: les constantes affichées par string (une même classe sert à
+            tous les jeux de même taille, voir transition_system)
+            """
+            self.step = i
+            self.numbers = numbers
+            self.index = Int(f"index[{i}]", ctx)
+            self.stack = Array(f"stack[{i}]", IntSort(ctx), BitVecSort(bits, ctx))
+            self.numbers_used = [Bool(f"used[{i}]({n})", ctx) for n, _ in enumerate(numbers)]
+
+        def peek(self, k: int):
+            """
+            Expression Z3 du k-ième élément de la pile en partant du sommet (k = 1 pour le sommet)
+            """
+            return self.stack[self.index - k]
+
+        def string(self, model: Model) -> str:
+            """
+            Chaine de caractères représentant l'état self avec les
+            valeurs attribuées au model après résolution
+            """
+            stack_repr = ", ".join((
+                str(model.eval(self.stack[i]).as_long()) for i in range(model[self.index].as_long())
+            ))
+            numbers_used = " ".join((
+                f"🗹 {number_used}"
+                if model[self.numbers_used[i]]
+                else f"☐ {number_used}"
+                for i, number_used in enumerate(self.numbers)
+            ))
+            return f"Stack : [{stack_repr}]" + "\n" + f"Numbers : {numbers_used}"
+
+    return State
+
+
+def mk_RegisterState(numbers: List[int], bits: int, ctx: Optional[Context] = None):
+    """
+    Variante de mk_State où la pile est représentée par des registres : la pile ne
+    peut pas contenir plus de N = len(numbers) éléments, on utilise donc N bitvecteurs
+    et un index sur ceil(log2(N + 1)) bits. Contrairement à mk_State, les formules
+    n'utilisent ni la théorie des tableaux ni l'arithmétique entière.
+    :param numbers: la liste des constantes entières c_1, ..., c_N
+    :param bits: le nombre de bits des bits vecteurs utilisés
+    :param ctx: le contexte Z3 des variables (None pour le contexte par défaut)
+    :return: Une classe qui modèle un état
+    """
+    index_bits = len(numbers).bit_length()
+
+    @dataclass
+    class State:
+        """
+        L'état de l’automate est représenté par :
+        * N registres (bitvecteurs non signés) encodant la pile, seuls les index
+        premiers registres ont une signification
+        * l’index (bitvecteur) du prochain registre libre
+        * une liste de booléens qui indique si la ième constante a déjà été utilisée
+        """
+        index: z3.BitVecRef
+        stack: List[z3.BitVecRef]
+        numbers_used: List[z3.BoolRef]
+
+        def __init__(self, i, numbers=numbers):
+            """
+            :param numbers: les constantes affichées par string (une même classe sert à
+            tous les jeux de même taille, voir transition_system)
+            """
+            self.step = i
+            self.numbers = numbers
+            self.index = BitVec(f"index[{i}]", index_bits, ctx)
+            self.stack = [BitVec(f"stack[{i}][{k}]", bits, ctx) for k, _ in enumerate(numbers)]
+            self.numbers_used = [Bool(f"used[{i}]({n})", ctx) for n, _ in enumerate(numbers)]
+
+        def peek(self, k: int):
+            """
+            Expression Z3 du k-ième élément de la pile en partant du sommet (k = 1 pour le sommet)
+            """
+            element = self.stack[0]
+            for index in range(k + 1, len(numbers) + 1):
+                element = If(self.index == index, self.stack[index - k], element)
+            return element
 
         def string(self, model: Model) -> str:
             """
@@ -58,7 +132,7 @@ def mk_State(numbers: List[int], bits: int):
                 f"🗹 {number_used}"
                 if model[self.numbers_used[i]]
                 else f"☐ {number_used}"
-                for i, number_used in enumerate(numbers)
+                for i, number_used in enumerate(self.numbers)
             ))
             return f"Stack : [{stack_repr}]" + "\n" + f"Numbers : {numbers_used}"
 
@@ -159,7 +233,8 @@ def div_formula(state_pre, state_post):
     :param state_post: state après l'action
     :return: prédicat (formule z3)
     """
-    quotient = BitVec(str(uuid4()), state_pre.stack[0].size())
+    quotient = BitVec(f"quotient[{state_pre.step}]", state_pre.stack[0].size(),
+                      state_pre.index.ctx)
     return And(
         # précondition
         # deux éléments au moins dans la pile
@@ -206,6 +281,215 @@ def push_formula(numbers: List[int], ith: int, state_pre, state_post):
     )
 
 
+def add_operation(no_overflow: bool, top, below, result):
+    """
+    Formule liant les deux éléments au sommet de la pile et le résultat de l'action add
+    (utilisée par l'encodage par registres, voir register_operation_formula)
+    """
+    return And(
+        BVAddNoOverflow(top, below, signed=False) if no_overflow else True,
+        result == top + below,
+    )
+
+
+def sub_operation(top, below, result):
+    """
+    Formule liant les deux éléments au sommet de la pile et le résultat de l'action sub
+    """
+    return And(UGE(top, below), result == top - below)
+
+
+def mult_operation(no_overflow: bool, top, below, result):
+    """
+    Formule liant les deux éléments au sommet de la pile et le résultat de l'action mult
+    """
+    return And(
+        BVMulNoOverflow(top, below, signed=False) if no_overflow else True,
+        result == top * below,
+    )
+
+
+def div_operation(top, below, result):
+    """
+    Formule liant les deux éléments au sommet de la pile et le résultat de l'action div.
+    Le résultat joue le rôle du quotient de div_formula.
+    """
+    return And(
+        below != 0,
+        BVMulNoOverflow(result, below, signed=False),
+        result * below == top,
+    )
+
+
+def register_operation_formula(operation, state_pre, state_post):
+    """
+    Prédicat vrai si state_pre et state_post (encodage par registres) sont des états liés
+    par une opération arithmétique
+    :param operation: fonction (top, below, result) -> formule z3 décrivant l'opération
+    :param state_pre: state avant l'action
+    :param state_post: state après l'action
+    :return: prédicat (formule z3)
+    """
+    size = len(state_pre.stack)
+    return And(
+        # état de la pile après l'opération
+        state_post.index == state_pre.index - 1,
+        # une alternative par valeur possible de l'index (au moins deux éléments dans la pile)
+        Or([And(
+            state_pre.index == k,
+            operation(state_pre.stack[k - 1], state_pre.stack[k - 2], state_post.stack[k - 2]),
+            # les registres sous les opérandes ne changent pas
+            *[state_post.stack[j] == state_pre.stack[j] for j in range(k - 2)],
+        ) for k in range(2, size + 1)]),
+        And([used1 == used2 for used1, used2 in
+             zip(state_pre.numbers_used, state_post.numbers_used)]),
+    )
+
+
+def register_push_formula(numbers: List[int], ith: int, state_pre, state_post):
+    """
+    Prédicat vrai si state_pre et state_post (encodage par registres) sont des états liés
+    par l'action push_{numbers[ith]}
+    :param numbers: liste des constantes
+    :param ith: indice de la constante à pousser (commence à 0)
+    :param state_pre: état avant l'action
+    :param state_post: état après l'action
+    :return: prédicat (formule z3)
+    """
+    return And(
+        # précondition
+        # la constante n'a pas déjà était utilisée
+        Not(state_pre.numbers_used[ith]),
+        # état de la pile après l'opération
+        state_post.numbers_used[ith],
+        *[used_pre == used_post
+          for i, (used_pre, used_post) in enumerate(
+                zip(state_pre.numbers_used, state_post.numbers_used)
+            )
+          if i != ith],
+        state_post.index == state_pre.index + 1,
+        Or([And(
+            state_pre.index == k,
+            state_post.stack[k] == numbers[ith],
+            *[state_post.stack[j] == state_pre.stack[j] for j in range(k)],
+        ) for k in range(len(numbers))]),
+    )
+
+
+def mk_actions(numbers: List[int], no_overflow: bool, encoding: str):
+    """
+    Retourne le dictionnaire des actions (nom -> formule de transition) pour l'encodage choisi
+    :param numbers: liste des constantes
+    :param no_overflow: vrai si on interdit les overflow faux sinon
+    :param encoding: "array" (pile dans un tableau Z3) ou "registers" (pile dans des registres)
+    """
+    if encoding == "array":
+        return {
+            **{"add": partial(add_formula, no_overflow),
+               "sub": sub_formula,
+               "mult": partial(mult_formula, no_overflow),
+               "div": div_formula},
+            **{f"push_{i}": partial(push_formula, numbers, i) for i in range(len(numbers))},
+        }
+    elif encoding == "registers":
+        return {
+            **{"add": partial(register_operation_formula, partial(add_operation, no_overflow)),
+               "sub": partial(register_operation_formula, sub_operation),
+               "mult": partial(register_operation_formula, partial(mult_operation, no_overflow)),
+               "div": partial(register_operation_formula, div_operation)},
+            **{f"push_{i}": partial(register_push_formula, numbers, i) for i in range(len(numbers))},
+        }
+    raise ValueError(f"Encodage inconnu : {encoding}")
+
+
+def _constrained(formula, constraint, state_pre, state_post):
+    return And(formula(state_pre, state_post), constraint(state_pre, state_post))
+
+
+def symmetry_breaking(actions, numbers: List[int], objective: int, approx: bool, bits: int,
+                      redundant: bool = True):
+    """
+    Ajoute aux formules des actions des contraintes qui éliminent des traces redondantes.
+    Toute trace éliminée est équivalente à une trace conservée de même longueur
+    (en échangeant les opérandes d'une opération commutative ou deux constantes égales)
+    ou à une trace plus courte qui donne le même résultat. La profondeur de la première
+    solution trouvée par bmc et la meilleure approximation de bmc_approx sont donc inchangées.
+    * les constantes égales sont poussées dans l'ordre de leurs indices ;
+    * pour add et mult, l'élément sous le sommet est inférieur ou égal au sommet ;
+    * les opérations neutres ou absorbantes (x+0, x-0, x*1, x*0, x/1, 0/x) sont interdites ;
+    * une soustraction qui donne 0 est interdite sauf si 0 peut être la meilleure réponse :
+    un 0 intermédiaire ne sert à rien et une constante seule fait sinon au moins aussi bien.
+    :param actions: le dictionnaire des actions (voir mk_actions)
+    :param numbers: liste des constantes
+    :param objective: le résultat recherché
+    :param approx: True pour la résolution approchée
+    :param bits: Nombre de bits des bit vecteurs
+    :param redundant: False pour ne garder que les deux premières contraintes : seules les
+    traces qui ne diffèrent d'une trace conservée que par l'ordre des opérandes ou des
+    constantes égales (même forme canonique, voir search.canonical_expression) sont éliminées
+    :return: un nouveau dictionnaire d'actions
+    """
+    if not redundant:
+        constraints = {
+            "add": lambda pre, post: ULE(pre.peek(2), pre.peek(1)),
+            "mult": lambda pre, post: ULE(pre.peek(2), pre.peek(1)),
+        }
+    else:
+        if approx:
+            zero_distance = distance(0, objective, bits)
+            zero_useful = zero_distance is not None and all(
+                distance(number, objective, bits) is None
+                or distance(number, objective, bits) > zero_distance
+                for number in numbers
+            )
+        else:
+            zero_useful = objective == 0
+        constraints = {
+            "add": lambda pre, post: And(pre.peek(2) != 0, ULE(pre.peek(2), pre.peek(1))),
+            "sub": lambda pre, post: And(pre.peek(2) != 0,
+                                         True if zero_useful else pre.peek(1) != pre.peek(2)),
+            "mult": lambda pre, post: And(UGT(pre.peek(2), 1), ULE(pre.peek(2), pre.peek(1))),
+            "div": lambda pre, post: And(pre.peek(2) != 1, pre.peek(1) != 0),
+        }
+    for ith, number in enumerate(numbers):
+        previous = [i for i in range(ith) if numbers[i] == number]
+        if previous:
+            # la précédente constante de même valeur a déjà été poussée
+            constraints[f"push_{ith}"] = partial(
+                lambda i, pre, post: pre.numbers_used[i], previous[-1])
+
+    return {
+        name: partial(_constrained, formula, constraints[name]) if name in constraints else formula
+        for name, formula in actions.items()
+    }
+
+
+def stop_formula(state_pre, state_post):
+    """
+    Prédicat vrai si state_post est identique à state_pre (action stop utilisée par
+    le moteur en une seule requête, voir bmc_single)
+    :param state_pre: state avant l'action
+    :param state_post: state après l'action
+    :return: prédicat (formule z3)
+    """
+    return And(
+        state_post.index == state_pre.index,
+        state_post.stack == state_pre.stack if is_array(state_pre.stack)
+        else And([register_pre == register_post for register_pre, register_post in
+                  zip(state_pre.stack, state_post.stack)]),
+        And([used1 == used2 for used1, used2 in
+             zip(state_pre.numbers_used, state_post.numbers_used)]),
+    )
+
+
+def odd_depth(nb_transitions: int) -> bool:
+    """
+    Une pile réduite à un seul élément n'est atteinte qu'après un nombre impair de transitions
+    (k push et k - 1 opérations) : les autres profondeurs n'ont pas besoin d'être vérifiées
+    """
+    return nb_transitions % 2 == 1
+
+
 def final_predicate(target_number: int, state):
     """
     Retourne un prédicat (formule Z3) caractérisant les états finaux du système
@@ -215,38 +499,479 @@ def final_predicate(target_number: int, state):
     return And(state.index == 1, state.stack[0] == target_number)
 
 
-def solve(input: GameInput, approx: bool, no_overflow: bool, bits: int) -> Optional[Solution]:
+def narrow_bits(input: GameInput) -> int:
+    """
+    Largeur de la première résolution de bits="auto" : les constantes et l'objectif sont
+    représentables et l'objectif reste positif en représentation signée (voir
+    final_state_approx_constraints)
+    """
+    return max(number.bit_length() for number in input.numbers + [input.objective]) + 1
+
+
+def _build_template(nb_numbers: int, no_overflow: bool, bits: int, encoding: str,
+                    ctx: Optional[Context]):
+    constants = [BitVec(f"number[{i}]", bits, ctx) for i in range(nb_numbers)]
+    State = mk_RegisterState(constants, bits, ctx) if encoding == "registers" \
+        else mk_State(constants, bits, ctx)
+    return Unrolling(State, mk_actions(constants, no_overflow, encoding)), constants
+
+
+@lru_cache(maxsize=32)
+def _default_template(nb_numbers: int, no_overflow: bool, bits: int, encoding: str):
+    return _build_template(nb_numbers, no_overflow, bits, encoding, None)
+
+
+def _unrolling_template(nb_numbers: int, no_overflow: bool, bits: int, encoding: str,
+                        ctx: Optional[Context]):
+    """
+    Dépliage des transitions où les constantes sont des variables Z3 number[i] : il ne dépend
+    que du nombre de constantes, de la largeur et de la sémantique des opérations et est
+    partagé par toutes les résolutions qui ont ces paramètres (dans le même contexte Z3).
+    Les dépliages du contexte par défaut sont gardés dans un cache LRU, ceux d'un autre
+    contexte dans un attribut du contexte : ils sont libérés avec lui.
+    :return: le dépliage (dont la classe des états, State) et les variables des constantes
+    """
+    if ctx is None:
+        return _default_template(nb_numbers, no_overflow, bits, encoding)
+    if not hasattr(ctx, "unrolling_templates"):
+        ctx.unrolling_templates = {}
+    key = (nb_numbers, no_overflow, bits, encoding)
+    if key not in ctx.unrolling_templates:
+        ctx.unrolling_templates[key] = _build_template(nb_numbers, no_overflow, bits, encoding,
+                                                       ctx)
+    return ctx.unrolling_templates[key]
+
+
+def transition_system(input: GameInput, approx: bool, no_overflow: bool, bits: int,
+                      encoding: str = "array", symmetry: bool = False,
+                      ctx: Optional[Context] = None, formulas: bool = False):
+    """
+    Construit la classe des états et les actions du système de transitions (voir solve
+    pour les paramètres)
+    :param formulas: True pour construire le dictionnaire des actions même lorsqu'il n'est
+    pas utilisé par le dépliage (moteur single, symmetry_breaking)
+    :return: la classe State, le dictionnaire des actions et le dépliage des transitions.
+    La classe State est celle du dépliage de _unrolling_template, partagée par les jeux de même
+    taille. Sans symmetry, les formules des transitions sont celles de ce dépliage où les
+    constantes sont remplacées par leurs valeurs, et les actions valent None sans formulas.
+    """
+    template, constants = _unrolling_template(len(input.numbers), no_overflow, bits, encoding,
+                                              ctx)
+    State = partial(template.State, numbers=input.numbers)
+    actions = None
+    if symmetry or formulas:
+        actions = mk_actions(input.numbers, no_overflow, encoding)
+    if symmetry:
+        # les contraintes de symmetry_breaking dépendent des valeurs des constantes
+        actions = symmetry_breaking(actions, input.numbers, input.objective, approx, bits)
+        return State, actions, Unrolling(State, actions)
+    substitution = [(constant, BitVecVal(number, bits, ctx))
+                    for constant, number in zip(constants, input.numbers)]
+    return State, actions, Unrolling(State, actions, template, substitution)
+
+
+def solve(input: GameInput, approx: bool, no_overflow: bool, bits: Union[int, str],
+          backend: str = "smt",
+          timeout: Optional[float] = None, mk_solver=Solver, encoding: str = "array",
+          symmetry: bool = False, engine: str = "incremental", cache=None, index=None,
+          observer: Optional[Callable[[DepthEvent], None]] = None,
+          counters: Optional[Counters] = None, ctx: Optional[Context] = None,
+          interrupt: Optional[Interrupt] = None, presolve: bool = True
+          ) -> Optional[Union[Solution, SearchSolution]]:
     """
     Résout le problème du "compte est bon"
     :param input:
     :param approx: True si on recherche la séquence d’actions qui produit le résultat
     le plus proche en valeur absolue du résultat demandé, False si on cherche une solution exacte.
     :param no_overflow: True si on interdit les dépassements d'entiers, False sinon
-    :param bits: Nombre de bits des bit vecteurs
-    :return:
+    :param bits: Nombre de bits des bit vecteurs, ou "auto" pour résoudre le problème sur les
+    entiers (sans dépassement quel que soit no_overflow) : une première résolution est faite sur
+    une petite largeur (narrow_bits) et la largeur n'est portée à safe_bits que si nécessaire
+    :param backend: "smt" pour l'encodage Z3 (bounded model checking),
+    "search" pour la recherche directe de search.py (renvoie alors un SearchSolution),
+    "portfolio" pour lancer en parallèle plusieurs configurations (voir portfolio.py),
+    "cubes" pour répartir l'espace de recherche d'une résolution exacte sur plusieurs
+    processus (voir cubes.py)
+    :param timeout: Durée maximale de la résolution en secondes (TimeoutError au-delà)
+    :param mk_solver: Fonction qui crée le solveur Z3 utilisé par le backend "smt"
+    :param encoding: encodage de la pile pour le backend "smt" : "array" (tableau Z3 indexé
+    par un entier) ou "registers" (N bitvecteurs et un index bitvecteur)
+    :param symmetry: True pour ajouter les contraintes de symmetry_breaking aux transitions
+    :param engine: "incremental" pour un appel au solveur par profondeur (bmc, bmc_approx),
+    "single" pour une seule requête sur la trace dépliée jusqu'à la profondeur maximale
+    (bmc_single, bmc_approx_single)
+    :param cache: un cache.SolutionCache consulté avant la résolution (la solution renvoyée
+    est alors un SearchSolution), None pour ne pas utiliser de cache
+    :param index: un reachability.ReachabilityIndex. Pour un jeu qu'il couvre, l'absence de
+    solution exacte est décidée sans appel au solveur et, en résolution approchée, le
+    meilleur écart connu arrête la recherche dès qu'une trace l'atteint
+    :param observer: fonction appelée avec un model_checker.DepthEvent après chaque profondeur
+    vérifiée par le backend "smt" (durée, statut, statistiques de Z3...)
+    :param counters: un model_checker.Counters que la résolution met à jour (nombre d'appels
+    au solveur, durées...), consultable même si la résolution échoue
+    :param ctx: le contexte Z3 dans lequel construire les formules, None pour le contexte
+    par défaut. Les formules déjà construites dans ce contexte pour un jeu de même taille
+    sont réutilisées. Avec mk_solver=Solver, le solveur est créé dans ce contexte.
+    :param interrupt: un model_checker.Interrupt permettant d'arrêter depuis un autre thread
+    la résolution par le backend "smt" (model_checker.Cancelled est alors levée)
+    :param presolve: True pour appliquer d'abord les filtres de presolve.py : les cas triviaux
+    sont résolus sans appel au solveur et, en résolution approchée, les bornes de l'écart
+    qu'ils donnent sont imposées au critère
+    :return: un model_checker.Solution pour le backend "smt" (sans cache), un SearchSolution
+    pour les autres backends ou avec un cache, None si le problème est insatisfiable
     """
-    for number in input.numbers:
-        if number.bit_length() > bits:
-            raise ValueError(f"{number} n'est pas représentable sur {bits} bits")
-    if input.objective.bit_length() > bits:
-        raise ValueError(f"L'objectif à atteindre {input.objective} n'est pas représentable sur {bits} bits")
-
-    actions = {
-        **{"add": partial(add_formula, no_overflow),
-           "sub": sub_formula,
-           "mult": partial(mult_formula, no_overflow),
-           "div": div_formula},
-        **{f"push_{i}": partial(push_formula, input.numbers, i) for i in range(len(input.numbers))},
-    }
+    if bits == "auto":
+        return _solve_auto(input, approx, backend=backend, timeout=timeout, mk_solver=mk_solver,
+                           encoding=encoding, symmetry=symmetry, engine=engine, cache=cache,
+                           index=index, observer=observer, counters=counters, ctx=ctx,
+                           interrupt=interrupt, presolve=presolve)
+    check_bits(input.numbers, [input.objective], bits)
+
+    if cache is not None:
+        return cache.solve(input, approx, no_overflow, bits, backend=backend, timeout=timeout,
+                           mk_solver=mk_solver, encoding=encoding, symmetry=symmetry,
+                           engine=engine, index=index, observer=observer, counters=counters,
+                           ctx=ctx, interrupt=interrupt, presolve=presolve)
+
+    # écart optimal à l'objectif, lorsqu'il est connu grâce à l'index
+    difference = None
+    if index is not None and index.covers(input.numbers, input.objective, no_overflow, bits):
+        if not approx and not index.reachable(input.numbers, input.objective):
+            return None
+        if approx:
+            difference = abs(index.closest(input.numbers, input.objective) - input.objective)
+
+    filters = Presolve()
+    if presolve:
+        # la borne de la recherche en faisceau n'est utilisée que par le backend smt, et
+        # seulement si l'écart optimal n'est pas connu
+        # le backend smt renvoie toujours un model_checker.Solution
+        filters = apply_filters(input, approx, no_overflow, bits,
+                                beam_width=16 if backend == "smt" and difference is None else 0,
+                                tile_trace=backend != "smt")
+        if filters.decided:
+            return filters.solution
+        if approx and difference is None and filters.upper_bound is not None \
+                and filters.upper_bound <= filters.lower_bound:
+            difference = filters.upper_bound
 
+    if backend == "search":
+        return search(input.numbers, input.objective, approx, no_overflow, bits, timeout)
+    elif backend == "portfolio":
+        from portfolio import solve_portfolio
+        return solve_portfolio(input, approx, no_overflow, bits, timeout=timeout)[0]
+    elif backend == "cubes":
+        from cubes import solve_cubes
+        return solve_cubes(input, approx, no_overflow, bits, timeout=timeout, encoding=encoding,
+                           symmetry=symmetry)
+    elif backend != "smt":
+        raise ValueError(f"Backend inconnu : {backend}")
+
+    if ctx is not None and mk_solver is Solver:
+        mk_solver = partial(Solver, ctx=ctx)
+    State, actions, unrolling = transition_system(input, approx, no_overflow, bits, encoding,
+                                                  symmetry, ctx, formulas=engine == "single")
     diametre_reoccurence = 2 * len(input.numbers) - 1
+    if approx and difference is not None:
+        # il suffit de chercher la trace la plus courte qui atteint l'écart optimal
+        final = partial(final_state_difference_predicate, input.objective, difference)
+        if engine == "single":
+            solution = bmc_single(State, actions, init_predicate, final, diametre_reoccurence,
+                                  stop_formula, timeout, mk_solver, odd_depth, observer, counters,
+                                  interrupt)
+        elif engine == "incremental":
+            solution = bmc(State, actions, init_predicate, final, diametre_reoccurence, timeout,
+                           mk_solver, odd_depth, observer, counters, unrolling, interrupt)
+        else:
+            raise ValueError(f"Moteur inconnu : {engine}")
+        solution.difference = difference
+        return solution
+    if engine == "single":
+        if approx:
+            return bmc_approx_single(State, actions, init_predicate,
+                                     partial(final_state_approx_constraints, input.objective),
+                                     diametre_reoccurence, stop_formula, timeout, mk_solver,
+                                     odd_depth, observer, counters, interrupt,
+                                     filters.upper_bound)
+        return bmc_single(State, actions, init_predicate,
+                          partial(final_predicate, input.objective), diametre_reoccurence,
+                          stop_formula, timeout, mk_solver, odd_depth, observer, counters,
+                          interrupt)
+    elif engine != "incremental":
+        raise ValueError(f"Moteur inconnu : {engine}")
     if approx:
-        return bmc_approx(mk_State(input.numbers, bits), actions, init_predicate,
+        return bmc_approx(State, actions, init_predicate,
                           partial(final_state_approx_constraints, input.objective),
-                          diametre_reoccurence)
+                          diametre_reoccurence, timeout, mk_solver, odd_depth, observer,
+                          counters, unrolling, interrupt, filters.lower_bound,
+                          filters.upper_bound)
     else:
-        return bmc(mk_State(input.numbers, bits), actions, init_predicate,
-               partial(final_predicate, input.objective), diametre_reoccurence)
+        return bmc(State, actions, init_predicate,
+               partial(final_predicate, input.objective), diametre_reoccurence, timeout,
+               mk_solver, odd_depth, observer, counters, unrolling, interrupt)
+
+
+def _solve_auto(input: GameInput, approx: bool, timeout: Optional[float], **options):
+    """
+    solve avec bits="auto". Une solution trouvée sans dépassement sur une petite largeur
+    est valable sur les entiers. Sinon (résolution exacte) on recommence à la largeur
+    safe_bits. En résolution approchée, l'écart de la solution est recalculé sur les entiers
+    (l'écart calculé par Z3 sur une petite largeur peut être faux) puis on vérifie à la
+    largeur safe_bits qu'aucune trace ne fait mieux, ce qui ne demande qu'une recherche
+    exacte ; la résolution approchée complète à cette largeur n'est faite que si c'est le cas.
+    """
+    remaining = countdown(timeout)
+    narrow, wide = narrow_bits(input), safe_bits(input, approx)
+    if narrow >= wide or options["backend"] == "search" \
+            or (approx and options["backend"] != "smt"):
+        return solve(input, approx, True, wide, timeout=remaining(), **options)
+    solution = solve(input, approx, True, narrow, timeout=remaining(), **options)
+    if not approx:
+        if solution is not None:
+            return solution
+        return solve(input, False, True, wide, timeout=remaining(), **options)
+
+    actions = list(solution.actions_effectuees())
+    difference = abs(replay(input.numbers, actions, narrow, True)[-1][0] - input.objective)
+    solution.difference = difference
+    if difference == 0:
+        return solution
+    mk_solver, ctx = options["mk_solver"], options["ctx"]
+    if ctx is not None and mk_solver is Solver:
+        mk_solver = partial(Solver, ctx=ctx)
+    State, actions, unrolling = transition_system(input, True, True, wide, options["encoding"],
+                                                  options["symmetry"], ctx,
+                                                  formulas=options["engine"] == "single")
+    final = partial(final_state_closer_predicate, input.objective, difference)
+    arguments = (options["observer"], options["counters"])
+    if options["engine"] == "single":
+        better = bmc_single(State, actions, init_predicate, final, 2 * len(input.numbers) - 1,
+                            stop_formula, remaining(), mk_solver, odd_depth, *arguments,
+                            options["interrupt"])
+    else:
+        better = bmc(State, actions, init_predicate, final, 2 * len(input.numbers) - 1,
+                     remaining(), mk_solver, odd_depth, *arguments, unrolling,
+                     options["interrupt"])
+    if better is None:
+        return solution
+    return solve(input, True, True, wide, timeout=remaining(), **options)
+
+
+def solve_iter(input: GameInput, no_overflow: bool, bits: int, timeout: Optional[float] = None,
+               mk_solver=Solver, encoding: str = "array", symmetry: bool = False,
+               interrupt: Optional[Interrupt] = None, index=None, lower_bound: int = 0,
+               observer: Optional[Callable[[DepthEvent], None]] = None,
+               counters: Optional[Counters] = None, ctx: Optional[Context] = None
+               ) -> Iterator[Solution]:
+    """
+    Résolution approchée en continu : produit une solution à chaque fois que le meilleur écart
+    à l'objectif s'améliore (voir bmc_approx_iter). Le générateur se termine sans erreur
+    lorsque la solution optimale est trouvée, à l'expiration du délai ou après
+    interrupt.cancel() : la dernière solution produite est la meilleure connue à cet instant.
+    :param lower_bound: écart minimal connu, la recherche s'arrête dès qu'il est atteint.
+    Si index couvre le jeu, l'écart optimal qu'il donne est utilisé.
+    Les autres paramètres sont ceux de solve.
+    :return: un générateur de Solution
+    """
+    check_bits(input.numbers, [input.objective], bits)
+    if index is not None and index.covers(input.numbers, input.objective, no_overflow, bits):
+        lower_bound = max(lower_bound,
+                          abs(index.closest(input.numbers, input.objective) - input.objective))
+
+    if ctx is not None and mk_solver is Solver:
+        mk_solver = partial(Solver, ctx=ctx)
+    State, actions, unrolling = transition_system(input, True, no_overflow, bits, encoding,
+                                                  symmetry, ctx)
+    try:
+        yield from bmc_approx_iter(State, actions, init_predicate,
+                                   partial(final_state_approx_constraints, input.objective),
+                                   2 * len(input.numbers) - 1, timeout, mk_solver, odd_depth,
+                                   lower_bound, interrupt, observer, counters, unrolling)
+    except TimeoutError:
+        return
+
+
+def solve_all(input: GameInput, approx: bool, no_overflow: bool, bits: int,
+              limit: Optional[int] = None, timeout: Optional[float] = None,
+              mk_solver=Solver, encoding: str = "array", symmetry: bool = True,
+              observer: Optional[Callable[[DepthEvent], None]] = None,
+              counters: Optional[Counters] = None, ctx: Optional[Context] = None,
+              interrupt: Optional[Interrupt] = None) -> Iterator[Solution]:
+    """
+    Énumère les solutions distinctes, des plus courtes aux plus longues (voir bmc_all) : en
+    résolution approchée, ce sont les traces qui atteignent l'écart optimal, calculé d'abord
+    par solve. Les traces dont l'expression a la même forme canonique qu'une trace déjà produite
+    (voir search.canonical_expression) sont ignorées : seuls l'ordre des opérandes des
+    additions et des multiplications et leur regroupement ((a + b) + c et a + (b + c)) sont
+    ignorés, deux expressions égales par d'autres règles (a - (b - c) et (a + c) - b, x * 1 et x)
+    sont données toutes les deux. Le générateur se termine sans erreur après limit solutions
+    ou à l'expiration du délai.
+    :param limit: nombre maximal de solutions produites, None pour toutes les produire
+    :param symmetry: True (par défaut) pour imposer l'ordre des opérandes des additions et
+    des multiplications et celui des constantes égales (symmetry_breaking avec
+    redundant=False) : le solveur trouve moins de variantes d'une même forme canonique, sans
+    qu'aucune forme ne soit éliminée
+    Les autres paramètres sont ceux de solve.
+    :return: un générateur de Solution
+    """
+    check_bits(input.numbers, [input.objective], bits)
+    remaining = countdown(timeout)
+    if ctx is not None and mk_solver is Solver:
+        mk_solver = partial(Solver, ctx=ctx)
+    difference = 0
+    final = partial(final_predicate, input.objective)
+    if approx:
+        try:
+            best = solve(input, True, no_overflow, bits, timeout=remaining(),
+                         mk_solver=mk_solver, encoding=encoding, symmetry=symmetry,
+                         interrupt=interrupt, ctx=ctx)
+        except TimeoutError:
+            return
+        if best is None:
+            # aucun écart à l'objectif n'est représentable
+            return
+        difference = best.difference
+        if difference != 0:
+            final = partial(final_state_difference_predicate, input.objective, difference)
+    State, actions, unrolling = transition_system(input, approx, no_overflow, bits, encoding,
+                                                  ctx=ctx, formulas=symmetry)
+    if symmetry:
+        actions = symmetry_breaking(actions, input.numbers, input.objective, approx, bits,
+                                    redundant=False)
+        unrolling = Unrolling(State, actions)
+    seen = set()
+    try:
+        for solution in bmc_all(State, actions, init_predicate, final,
+                                2 * len(input.numbers) - 1, remaining(), mk_solver,
+                                odd_depth, observer, counters, unrolling, interrupt):
+            expression = canonical_expression(input.numbers, list(solution.actions_effectuees()))
+            if expression in seen:
+                continue
+            seen.add(expression)
+            solution.difference = difference
+            yield solution
+            if limit is not None and len(seen) >= limit:
+                return
+    except TimeoutError:
+        return
+
+
+def _intervals(values: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Réunion d'intervalles d'entiers [début, fin], triée et sans chevauchement
+    """
+    merged = []
+    for low, high in sorted(values):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def _window(center: int, radius: int, bits: int) -> List[Tuple[int, int]]:
+    """
+    Les valeurs sur bits bits à une distance au plus radius de center, modulo 2^bits
+    (un ou deux intervalles)
+    """
+    modulo = 1 << bits
+    if 2 * radius + 1 >= modulo:
+        return [(0, modulo - 1)]
+    low, high = center - radius, center + radius
+    if low < 0:
+        return [(0, high), (low + modulo, modulo - 1)]
+    if high >= modulo:
+        return [(low, modulo - 1), (0, high - modulo)]
+    return [(low, high)]
+
+
+def _membership(intervals: List[Tuple[int, int]], value):
+    """
+    Prédicat : value (bitvecteur, non signé) appartient à l'un des intervalles
+    """
+    return Or([value == low if low == high else And(UGE(value, low), ULE(value, high))
+               for low, high in intervals])
+
+
+def solve_targets(numbers: List[int], objectives: Iterable[int], approx: bool,
+                  no_overflow: bool, bits: int, timeout: Optional[float] = None,
+                  mk_solver=Solver, encoding: str = "array",
+                  observer: Optional[Callable[[DepthEvent], None]] = None,
+                  counters: Optional[Counters] = None, ctx: Optional[Context] = None,
+                  interrupt: Optional[Interrupt] = None) -> Dict[int, Optional[Solution]]:
+    """
+    Résout le problème pour plusieurs objectifs avec les mêmes constantes en une seule
+    passe : les valeurs finales atteignables parmi les objectifs sont énumérées avec des
+    clauses de blocage (voir bmc_values) sur un même dépliage, chacune avec la trace la plus
+    courte. En résolution approchée, les valeurs proches des objectifs non atteints (à une
+    distance au plus égale à celle de la meilleure valeur connue : une constante ou le résultat
+    d'une recherche en faisceau) sont énumérées dans une seconde passe ; à écart égal, la trace
+    la plus courte est choisie. L'écart est celui de solve (voir search.distance) : les
+    fenêtres autour des objectifs sont prises modulo 2^bits.
+    :param numbers: liste des constantes
+    :param objectives: les objectifs
+    Les autres paramètres sont ceux de solve.
+    :return: un dictionnaire qui à chaque objectif associe sa solution (exacte ou la plus
+    proche en résolution approchée, avec son écart dans difference), None s'il n'y en a pas
+    """
+    objectives = sorted(set(objectives))
+    check_bits(numbers, objectives, bits)
+    remaining = countdown(timeout)
+    if ctx is not None and mk_solver is Solver:
+        mk_solver = partial(Solver, ctx=ctx)
+    input = GameInput(numbers=numbers, objective=0)
+    State, actions, unrolling = transition_system(input, approx, no_overflow, bits, encoding,
+                                                  ctx=ctx)
+
+    def enumerate_values(intervals: List[Tuple[int, int]]) -> Dict[int, Solution]:
+        if not intervals:
+            return {}
+        return dict(bmc_values(State, actions, init_predicate, final_state_value,
+                               partial(_membership, intervals), 2 * len(numbers) - 1,
+                               remaining(), mk_solver, odd_depth, observer, counters,
+                               unrolling, interrupt))
+
+    reached = enumerate_values(_intervals((objective, objective) for objective in objectives))
+    solutions = {objective: reached.get(objective) for objective in objectives}
+    missing = [objective for objective in objectives if objective not in reached]
+    if not approx or not missing:
+        return solutions
+
+    known = set(reached) | set(numbers)
+    windows = []
+    for objective in missing:
+        # la recherche en faisceau donne le plus souvent une valeur atteignable proche
+        found = beam(numbers, objective, no_overflow, bits)
+        if found is not None:
+            known.add(replay(numbers, found[1], bits, no_overflow)[-1][0])
+        # sans écart connu représentable, toute valeur à un écart représentable est candidate
+        radius = min((gap for gap in (distance(value, objective, bits) for value in known)
+                      if gap is not None), default=(1 << (bits - 1)) - 1)
+        windows += _window(objective, radius, bits)
+    # les objectifs manquants ne sont pas atteignables : les écarter ne change rien
+    reached.update(enumerate_values(_intervals(windows)))
+    for objective in missing:
+        best = min(((value, distance(value, objective, bits)) for value in reached
+                    if distance(value, objective, bits) is not None),
+                   key=lambda item: (item[1], len(reached[item[0]].transitions), item[0]),
+                   default=None)
+        if best is None:
+            # aucun écart n'est représentable, comme solve
+            continue
+        value, difference = best
+        closest = reached[value]
+        solutions[objective] = Solution(z3_model=closest.z3_model,
+                                        transitions=closest.transitions,
+                                        states=closest.states,
+                                        difference=difference)
+    return solutions
+
+
+def final_state_value(state):
+    """
+    États finaux (un seul nombre sur la pile) et leur valeur, voir bmc_values
+    """
+    return {'hard': state.index == 1, 'value': state.stack[0]}
 
 
 def Abs(x: z3.z3.ExprRef) -> z3.z3.ExprRef:
@@ -266,14 +991,32 @@ def final_state_approx_constraints(target_number, state):
     :param state: un état
     :return:
     """
-    distance = BitVec(str(uuid4()), state.stack[0].size())
+    distance = BitVec(f"distance[{state.step}]", state.stack[0].size(), state.index.ctx)
     return {
         'hard': And(state.index == 1, distance == Abs(state.stack[0] - target_number),
                     distance >= 0),
         'criterion': distance
     }
 
+def final_state_difference_predicate(target_number: int, difference: int, state):
+    """
+    Prédicat caractérisant les états finaux dont l'écart à target_number vaut difference
+    (au sens de final_state_approx_constraints)
+    """
+    constraints = final_state_approx_constraints(target_number, state)
+    return And(constraints['hard'], constraints['criterion'] == difference)
+
+def final_state_closer_predicate(target_number: int, difference: int, state):
+    """
+    Prédicat caractérisant les états finaux dont l'écart à target_number est strictement
+    inférieur à difference (au sens de final_state_approx_constraints)
+    """
+    constraints = final_state_approx_constraints(target_number, state)
+    return And(constraints['hard'], ULT(constraints['criterion'], difference))
+
 def solution_resulting_number(solution) -> int:
+    if isinstance(solution, SearchSolution):
+        return solution.resulting_number()
     # Le résultat du calcul est le premier nombre (et seul nombre) sur la pile
     # du dernier état
     return solution.z3_model.eval(solution.states[-1].stack[0])
@@ -285,6 +1028,12 @@ def print_result(solution):
         print("Résultat ", solution_resulting_number(solution))
         print("Actions : ", *solution.actions_effectuees())
 
+        if isinstance(solution, SearchSolution):
+            for i, stack in enumerate(solution.stacks):
+                print("―" * 50)
+                print("State", i)
+                print(f"Stack : {stack}")
+            return
         for i, state in enumerate(solution.states):
             print("―" * 50)
             print("State", i)
@@ -0,0 +1,141 @@
+"""
+Résolution exacte d'un seul jeu difficile par découpage en cubes (cube and conquer).
+
+Les traces sont réparties selon leurs split_depth premières actions : chaque cube est un
+préfixe valide (les opérations ne s'appliquent qu'à une pile d'au moins deux éléments, une
+constante n'est poussée qu'une fois et, parmi des constantes égales, celles d'indice
+plus petit sont poussées d'abord). Les cubes sont distribués à un pool de processus ; chaque
+processus vérifie les cubes qu'il reçoit avec un même solveur (model_checker.CubeChecker),
+en supposant vrais les booléens actions_done du préfixe (hypothèses de solver.check).
+
+Les profondeurs sont vérifiées l'une après l'autre pour tous les cubes, ce qui garantit,
+comme bmc, que la solution est la plus courte. À une profondeur plus petite que split_depth,
+les cubes sont tronqués à cette profondeur. Le premier cube satisfiable donne la solution
+et arrête les autres processus ; le problème n'est déclaré insatisfiable que lorsque tous
+les cubes sont réfutés à toutes les profondeurs.
+"""
+import logging
+import multiprocessing
+import os
+from functools import partial
+from queue import Empty
+from time import time
+from typing import List, Optional, Tuple
+
+from chiffres import GameInput, final_predicate, init_predicate, odd_depth, transition_system
+from model_checker import CubeChecker
+from portfolio import poll_timeout
+from search import OPERATIONS, SearchSolution, portable_solution
+
+
+def cubes(numbers: List[int], split_depth: int) -> List[Tuple[str, ...]]:
+    """
+    Les préfixes valides de split_depth actions (ou moins si la trace ne peut pas être
+    prolongée) : toute trace commence par exactement un de ces préfixes, à l'échange près
+    de constantes égales
+    """
+    prefixes = [((), 0, frozenset())]
+    for _ in range(split_depth):
+        extended = []
+        for prefix, height, used in prefixes:
+            following = [(f"push_{i}", height + 1, used | {i}) for i, number in enumerate(numbers)
+                         if i not in used
+                         and all(j in used for j in range(i) if numbers[j] == number)]
+            if height >= 2:
+                following += [(operation, height - 1, used) for operation in OPERATIONS]
+            extended += [(prefix + (action,), height, used) for action, height, used in following]
+            if not following:
+                extended.append((prefix, height, used))
+        prefixes = extended
+    return [prefix for prefix, _, _ in prefixes]
+
+
+def _worker(input: GameInput, no_overflow: bool, bits: int, encoding: str, symmetry: bool,
+            deadline: Optional[float], tasks, results):
+    _, _, unrolling = transition_system(input, False, no_overflow, bits, encoding,
+                                        symmetry)
+    checker = CubeChecker(unrolling, init_predicate, partial(final_predicate, input.objective))
+    while True:
+        depth, cube = tasks.get()
+        try:
+            assumptions = [unrolling.transition(step).actions_done[action]
+                           for step, action in enumerate(cube)]
+            solution = checker.check(depth, assumptions, deadline)
+            results.put((cube, portable_solution(solution, input, no_overflow, bits), None))
+        except TimeoutError:
+            results.put((cube, None, "timeout"))
+        except Exception as e:
+            results.put((cube, None, f"{type(e).__name__}: {e}"))
+
+
+def solve_cubes(input: GameInput, approx: bool, no_overflow: bool, bits: int,
+                split_depth: int = 2, workers: Optional[int] = None,
+                timeout: Optional[float] = None, encoding: str = "array",
+                symmetry: bool = False) -> Optional[SearchSolution]:
+    """
+    Résout le problème du "compte est bon" (résolution exacte seulement) en répartissant
+    les cubes sur un pool de processus
+    :param input: voir solve
+    :param approx: doit valoir False : le meilleur écart ne peut être connu qu'après
+    avoir exploré tous les cubes
+    :param no_overflow: voir solve
+    :param bits: voir solve
+    :param split_depth: nombre d'actions fixées par chaque cube
+    :param workers: nombre de processus (par défaut le nombre de coeurs)
+    :param timeout: Durée maximale de la résolution en secondes (TimeoutError au-delà)
+    :param encoding: voir solve
+    :param symmetry: voir solve
+    :return: la solution ou None si le problème est insatisfiable
+    """
+    if approx:
+        raise ValueError("La résolution par cubes n'est disponible qu'en résolution exacte")
+    begin = time()
+    deadline = None if timeout is None else begin + timeout
+    prefixes = cubes(input.numbers, split_depth)
+    tasks, results = multiprocessing.Queue(), multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_worker, daemon=True,
+                                args=(input, no_overflow, bits, encoding, symmetry, deadline,
+                                      tasks, results))
+        for _ in range(min(workers or os.cpu_count() or 1, len(prefixes)))
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for depth in range(1, 2 * len(input.numbers)):
+            if not odd_depth(depth):
+                continue
+            depth_cubes = list(dict.fromkeys(prefix[:depth] for prefix in prefixes))
+            for cube in depth_cubes:
+                tasks.put((depth, cube))
+            answered = 0
+            while answered < len(depth_cubes):
+                # un processus terminé a envoyé ses réponses avant de s'arrêter
+                exited = [process for process in processes if process.exitcode is not None]
+                try:
+                    cube, solution, error = results.get(timeout=poll_timeout(deadline))
+                except Empty:
+                    if deadline is not None and time() >= deadline:
+                        raise TimeoutError("Temps de résolution dépassé")
+                    # le cube en cours de vérification par ce processus est perdu
+                    if exited:
+                        raise AssertionError(f"Processus arrêté pendant la résolution des cubes "
+                                             f"(code {exited[0].exitcode})")
+                    continue
+                answered += 1
+                if error == "timeout":
+                    raise TimeoutError("Temps de résolution dépassé")
+                if error is not None:
+                    raise AssertionError(f"Échec de la résolution du cube {cube} : {error}")
+                if solution is not None:
+                    logging.info(f"Cubes : solution de longueur {depth} dans le cube {cube} "
+                                 f"({time() - begin:.2f}s)")
+                    return solution
+        logging.info(f"Cubes : les {len(prefixes)} cubes sont réfutés ({time() - begin:.2f}s)")
+        return None
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
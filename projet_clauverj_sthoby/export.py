@@ -0,0 +1,203 @@
+"""
+Export du problème déplié à une profondeur donnée, pour le soumettre à d'autres solveurs.
+
+Le problème exporté est celui que bmc vérifie à cette profondeur : l'état initial, les
+transitions et la propriété de l'état final (résultat égal à l'objectif ou, en résolution
+approchée, écart au plus égal à difference). Il est écrit au format SMT-LIB2 ou, après
+bit-blasting par Z3 (card2bv, bit-blast puis tseitin-cnf), au format DIMACS CNF : la pile est
+alors encodée par des registres (encoding="registers"), la théorie des tableaux ne se
+traduisant pas en bitvecteurs. Les variables des booléens actions_done (add[3], push_2[0]...)
+sont nommées dans les commentaires du fichier DIMACS ("c <variable> <nom>"), ce qui permet
+de relire la trace dans le modèle d'un solveur SAT.
+
+run_solver lance un solveur externe sur un fichier exporté et reconstruit la trace à partir de
+sa réponse : un modèle SMT-LIB ((get-model)) ou les lignes "s" et "v" de la compétition SAT.
+
+Usage : python3 export.py [--out DIR] [--format smt2|dimacs] [--depth D] [--bits 14]
+[--encoding registers] [--approx --difference D] [--solver "z3 -dimacs"] [--timeout 60] [jeux...]
+
+Les jeux sont les noms des jeux de games.py (par défaut tous). Avec --solver, chaque fichier
+exporté est résolu par la commande donnée (le chemin du fichier est ajouté à la fin).
+"""
+import os
+import re
+import subprocess
+from time import time
+from typing import List, Optional
+
+from z3 import Goal, Solver, Then, ULE
+
+from chiffres import GameInput, final_predicate, final_state_approx_constraints, init_predicate, \
+    transition_system
+from search import SearchSolution, distance, replay
+
+FORMATS = ("smt2", "dimacs")
+
+
+def unrolled_formulas(input: GameInput, approx: bool, no_overflow: bool, bits: int, depth: int,
+                      difference: Optional[int] = None, encoding: str = "array",
+                      symmetry: bool = False) -> List:
+    """
+    Formules du problème déplié sur depth transitions
+    :param difference: en résolution approchée, l'écart maximal à l'objectif
+    Les autres paramètres sont ceux de solve.
+    :return: la liste des formules Z3 (leur conjonction est le problème)
+    """
+    if approx and difference is None:
+        raise ValueError("L'écart maximal (difference) est nécessaire en résolution approchée")
+    _, _, unrolling = transition_system(input, approx, no_overflow, bits, encoding, symmetry)
+    formulas = [init_predicate(unrolling.state(0))]
+    formulas += [unrolling.transition(step).formula for step in range(depth)]
+    final = unrolling.state(depth)
+    if approx:
+        constraints = final_state_approx_constraints(input.objective, final)
+        formulas += [constraints['hard'], ULE(constraints['criterion'], difference)]
+    else:
+        formulas.append(final_predicate(input.objective, final))
+    return formulas
+
+
+def write_smtlib(path: str, formulas: List):
+    """
+    Écrit le problème au format SMT-LIB2, suivi de (check-sat) et (get-model)
+    """
+    solver = Solver()
+    solver.add(formulas)
+    with open(path, "w") as file:
+        file.write("(set-option :produce-models true)\n")
+        file.write(solver.to_smt2())
+        file.write("(get-model)\n")
+
+
+def write_dimacs(path: str, formulas: List):
+    """
+    Écrit le problème au format DIMACS CNF après bit-blasting, avec le nom des variables
+    en commentaire
+    """
+    goal = Goal()
+    goal.add(formulas)
+    subgoals = Then("simplify", "card2bv", "bit-blast", "tseitin-cnf")(goal)
+    assert len(subgoals) == 1
+    with open(path, "w") as file:
+        file.write(subgoals[0].dimacs())
+
+
+def export(input: GameInput, approx: bool, no_overflow: bool, bits: int, depth: int,
+           path: str, format: str = "smt2", difference: Optional[int] = None,
+           encoding: str = "array", symmetry: bool = False):
+    """
+    Écrit dans path le problème déplié sur depth transitions (voir unrolled_formulas)
+    :param format: smt2 ou dimacs (avec encoding="registers")
+    """
+    formulas = unrolled_formulas(input, approx, no_overflow, bits, depth, difference, encoding,
+                                 symmetry)
+    if format == "dimacs" and encoding != "registers":
+        raise ValueError("L'export DIMACS nécessite l'encodage registers")
+    if format == "smt2":
+        write_smtlib(path, formulas)
+    elif format == "dimacs":
+        write_dimacs(path, formulas)
+    else:
+        raise ValueError(f"Format inconnu : {format}")
+
+
+def _true_names(path: str, output: str) -> Optional[set]:
+    """
+    Noms des booléens vrais dans la réponse d'un solveur, None si le problème est insatisfiable
+    """
+    lines = output.split()
+    if path.endswith(".cnf"):
+        status = re.search(r"^s (\w+)", output, re.MULTILINE)
+        status = status and status.group(1)
+        if status == "UNSATISFIABLE":
+            return None
+        if status != "SATISFIABLE":
+            raise AssertionError(f"Réponse du solveur inattendue : {output[:200]}")
+        positive = {int(literal) for line in output.splitlines() if line.startswith("v ")
+                    for literal in line.split()[1:] if int(literal) > 0}
+        with open(path) as file:
+            names = [line.split()[1:3] for line in file if line.startswith("c ")]
+        return {name for variable, name in names if int(variable) in positive}
+    if lines and lines[0] == "unsat":
+        return None
+    if not lines or lines[0] != "sat":
+        raise AssertionError(f"Réponse du solveur inattendue : {output[:200]}")
+    return set(re.findall(r"\(define-fun \|?([^\s|]+)\|? \(\) Bool\s+true\)", output))
+
+
+def run_solver(command: List[str], path: str, input: GameInput, approx: bool, no_overflow: bool,
+               bits: int, depth: int, timeout: Optional[float] = None
+               ) -> Optional[SearchSolution]:
+    """
+    Résout un problème exporté par export avec un solveur externe
+    :param command: la commande du solveur, le chemin du fichier y est ajouté
+    :param path: le fichier exporté (.smt2 ou .cnf)
+    :param timeout: Durée maximale de la résolution en secondes (TimeoutError au-delà)
+    Les autres paramètres sont ceux de l'export.
+    :return: la trace trouvée ou None si le problème est insatisfiable
+    """
+    try:
+        completed = subprocess.run(command + [path], capture_output=True, text=True,
+                                   timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise TimeoutError("Temps de résolution dépassé")
+    true_names = _true_names(path, completed.stdout)
+    if true_names is None:
+        return None
+    candidates = ["add", "sub", "mult", "div"] + [f"push_{i}" for i in range(len(input.numbers))]
+    actions = []
+    for step in range(depth):
+        done = [action for action in candidates if f"{action}[{step}]" in true_names]
+        if len(done) != 1:
+            raise AssertionError(f"Le modèle ne donne pas l'action de la transition {step}")
+        actions += done
+    stacks = replay(input.numbers, actions, bits, no_overflow)
+    difference = distance(stacks[-1][0], input.objective, bits) if approx else 0
+    if difference is None:
+        raise AssertionError(f"L'écart de la trace du solveur n'est pas représentable : {actions}")
+    return SearchSolution(actions=actions, stacks=stacks, difference=difference)
+
+
+if __name__ == '__main__':
+    import argparse
+    import shlex
+
+    import games
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("games", nargs="*")
+    parser.add_argument("--out", default="export")
+    parser.add_argument("--format", choices=FORMATS, default="smt2")
+    parser.add_argument("--depth", type=int, help="par défaut 2N - 1 pour N constantes")
+    parser.add_argument("--bits", type=int, default=14)
+    parser.add_argument("--overflow", action="store_true", help="autorise les dépassements")
+    parser.add_argument("--encoding", help="par défaut array, registers pour dimacs")
+    parser.add_argument("--symmetry", action="store_true")
+    parser.add_argument("--approx", action="store_true")
+    parser.add_argument("--difference", type=int)
+    parser.add_argument("--solver", help="commande du solveur externe")
+    parser.add_argument("--timeout", type=float)
+    args = parser.parse_args()
+
+    encoding = args.encoding or ("registers" if args.format == "dimacs" else "array")
+    corpus = {name: game for name, game in vars(games).items() if isinstance(game, GameInput)}
+    os.makedirs(args.out, exist_ok=True)
+    for name in args.games or corpus:
+        game = corpus[name]
+        depth = args.depth or 2 * len(game.numbers) - 1
+        extension = "cnf" if args.format == "dimacs" else "smt2"
+        path = os.path.join(args.out, f"{name}-{depth}.{extension}")
+        begin = time()
+        export(game, args.approx, not args.overflow, args.bits, depth, path, args.format,
+               args.difference, encoding, args.symmetry)
+        print(f"{name} : {path} ({time() - begin:.2f}s)")
+        if args.solver:
+            begin = time()
+            try:
+                solution = run_solver(shlex.split(args.solver), path, game, args.approx,
+                                      not args.overflow, args.bits, depth, args.timeout)
+                status = "unsat" if solution is None else f"sat {' '.join(solution.actions)}"
+            except TimeoutError:
+                status = "timeout"
+            print(f"  {args.solver} : {status} ({time() - begin:.2f}s)")
@@ -1,8 +1,8 @@
 from dataclasses import dataclass
-from itertools import islice
-from typing import Dict, List, Any, Optional
-from uuid import uuid4
+from typing import Callable, Dict, Iterator, List, Any, Optional, Sequence, Tuple
 from logging import debug
+from time import time
+import threading
 
 from z3 import *
 
@@ -18,9 +18,12 @@ class Transition:
                 return name
 
 
-def transition(state1, state2, action_formulas):
-    # on créé des booléens pour indiquer si une action a été choisie
-    actions_done = {action: Bool(str(uuid4())) for action in action_formulas}
+def transition(state1, state2, action_formulas, step: int):
+    # on créé des booléens pour indiquer si une action a été choisie, nommés d'après l'action
+    # et le numéro de la transition : les mêmes noms désignent les mêmes variables Z3 d'une
+    # résolution à l'autre, ce qui permet de réutiliser les formules (voir Unrolling)
+    ctx = state1.index.ctx
+    actions_done = {action: Bool(f"{action}[{step}]", ctx) for action in action_formulas}
     formula = And(
         # Si le booléen correspondant à l'action est vrai alors l'action doit être effectuée
         *[Implies(actions_done[action], action_formulas[action](state1, state2)) for action in
@@ -32,6 +35,52 @@ def transition(state1, state2, action_formulas):
     return Transition(actions_done=actions_done, formula=formula)
 
 
+class Unrolling:
+    """
+    Dépliage de la relation de transition : les états et les transitions sont construits à la
+    demande puis conservés, de sorte qu'un même dépliage peut servir à plusieurs résolutions.
+    Avec template, les formules des transitions ne sont pas reconstruites en Python mais
+    obtenues à partir de celles de template par substitution (faite par Z3) : template
+    peut être construit une fois avec des constantes symboliques, remplacées ensuite par
+    leurs valeurs.
+    :param State: Une classe décrivant un état du système
+    :param action_formulas: voir bmc (inutilisé avec template)
+    :param template: un autre Unrolling dont les transitions portent sur les mêmes états
+    :param substitution: couples (expression de template, expression qui la remplace)
+    """
+
+    def __init__(self, State, action_formulas, template: Optional["Unrolling"] = None,
+                 substitution=()):
+        self.State = State
+        self.action_formulas = action_formulas
+        self.template = template
+        self.substitution = list(substitution)
+        self._states = []
+        self._transitions = []
+
+    def state(self, i: int):
+        while len(self._states) <= i:
+            self._states.append(self.State(len(self._states)))
+        return self._states[i]
+
+    def transition(self, i: int) -> Transition:
+        """
+        La transition de l'état i à l'état i + 1
+        """
+        while len(self._transitions) <= i:
+            step = len(self._transitions)
+            if self.template is None:
+                trans = transition(self.state(step), self.state(step + 1), self.action_formulas,
+                                   step)
+            else:
+                trans = self.template.transition(step)
+                if self.substitution:
+                    trans = Transition(formula=substitute(trans.formula, *self.substitution),
+                                       actions_done=trans.actions_done)
+            self._transitions.append(trans)
+        return self._transitions[i]
+
+
 @dataclass
 class Solution:
     z3_model: z3.z3.ModelRef
@@ -43,8 +92,151 @@ class Solution:
         return (transition.string(self.z3_model) for transition in self.transitions)
 
 
-def bmc(State, action_formulas, init_state_predicate, final_state_predicate, max_nb_transitions
-        ) -> Optional[Solution]:
+def _set_timeout(solver, deadline: Optional[float]):
+    """
+    Limite la durée du prochain appel à solver.check() au temps restant avant deadline
+    """
+    if deadline is None:
+        return
+    remaining = deadline - time()
+    if remaining <= 0:
+        raise TimeoutError("Temps de résolution dépassé")
+    solver.set("timeout", max(1, int(remaining * 1000)))
+
+
+def _raise_unknown(solver):
+    if solver.reason_unknown() in ("timeout", "canceled"):
+        raise TimeoutError("Temps de résolution dépassé")
+    raise AssertionError("Z3 formula satisfiability could not be determined")
+
+
+class Interrupt:
+    """
+    Permet d'interrompre depuis un autre thread une résolution en cours (voir bmc_approx_iter) :
+    cancel() interrompt l'appel au solveur en cours (Solver.interrupt) et empêche les suivants
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._solvers = []
+        self._lock = threading.Lock()
+
+    def attach(self, solver):
+        with self._lock:
+            self._solvers.append(solver)
+            if self.cancelled:
+                solver.interrupt()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for solver in self._solvers:
+                solver.interrupt()
+
+
+class Cancelled(Exception):
+    """
+    Levée par les bmc lorsque la résolution est interrompue (voir Interrupt)
+    """
+
+
+@dataclass
+class DepthEvent:
+    """
+    Événement transmis à l'observateur (paramètre observer des bmc) après la vérification
+    d'une profondeur
+    :param depth: nombre de transitions de la trace vérifiée
+    :param status: "sat", "unsat" ou "unknown"
+    :param duration: durée cumulée des appels à check() pour cette profondeur, en secondes
+    :param checks: nombre d'appels à check() pour cette profondeur
+    :param statistics: les statistiques de Z3 après le dernier appel (nom -> valeur)
+    :param assertions: nombre d'assertions du solveur
+    :param best_score: meilleur critère trouvé jusqu'ici (bmc_approx), None sinon
+    """
+    depth: int
+    status: str
+    duration: float
+    checks: int
+    statistics: Dict[str, Any]
+    assertions: int
+    best_score: Optional[int] = None
+
+
+@dataclass
+class Counters:
+    """
+    Compteurs d'une résolution (paramètre counters des bmc), tenus à jour à chaque appel au
+    solveur à un coût négligeable. Ils restent disponibles lorsque la résolution échoue
+    (TimeoutError par exemple).
+    """
+    depths: int = 0
+    checks: int = 0
+    sat: int = 0
+    unsat: int = 0
+    unknown: int = 0
+    # durée passée dans solver.check()
+    check_time: float = 0.0
+    # durée totale, construction des formules comprise
+    total_time: float = 0.0
+
+
+class _Probe:
+    """
+    Instrumentation des appels au solveur : met à jour les compteurs et transmet un
+    DepthEvent à l'observateur à la fin de chaque profondeur. Les statistiques de Z3 et le
+    nombre d'assertions, plus coûteux, ne sont calculés qu'en présence d'un observateur.
+    """
+
+    def __init__(self, solver, observer: Optional[Callable[[DepthEvent], None]],
+                 counters: Optional[Counters]):
+        self.solver = solver
+        self.observer = observer
+        self.counters = counters
+        self.best_score = None
+        self._begin = time()
+        self.start(0)
+
+    def start(self, depth: int):
+        self.depth = depth
+        self._duration = 0.0
+        self._checks = 0
+
+    def checked(self, status, duration: float):
+        self._duration += duration
+        self._checks += 1
+        if self.counters is not None:
+            self.counters.checks += 1
+            self.counters.check_time += duration
+            name = str(status)
+            setattr(self.counters, name, getattr(self.counters, name) + 1)
+
+    def end(self, status):
+        if self.counters is not None:
+            self.counters.depths += 1
+        if self.observer is not None:
+            statistics = self.solver.statistics()
+            self.observer(DepthEvent(
+                depth=self.depth,
+                status=str(status),
+                duration=self._duration,
+                checks=self._checks,
+                statistics={key: statistics.get_key_value(key) for key in statistics.keys()},
+                assertions=len(self.solver.assertions()),
+                best_score=self.best_score,
+            ))
+
+    def close(self):
+        if self.counters is not None:
+            self.counters.total_time += time() - self._begin
+
+
+def bmc(State, action_formulas, init_state_predicate, final_state_predicate, max_nb_transitions,
+        timeout: Optional[float] = None, mk_solver: Callable[[], Solver] = Solver,
+        candidate_depth: Optional[Callable[[int], bool]] = None,
+        observer: Optional[Callable[[DepthEvent], None]] = None,
+        counters: Optional[Counters] = None,
+        unrolling: Optional[Unrolling] = None,
+        interrupt: Optional[Interrupt] = None) -> Optional[Solution]:
     """
     Bounded Model Checking
     :param State: Une classe décrivant un état du système
@@ -54,71 +246,303 @@ def bmc(State, action_formulas, init_state_predicate, final_state_predicate, max
     :param init_state_predicate: Formule Z3 (prédicat) sur l'état initial du système
     :param final_state_predicate: Formule Z3 (prédicat) sur l'état final du système
     :param max_nb_transitions: Borne maximale du nombre de transitions effectué
+    :param timeout: Durée maximale de la résolution en secondes (TimeoutError au-delà),
+    None pour ne pas limiter la durée
+    :param mk_solver: Fonction sans argument qui crée le solveur Z3 utilisé (tactique, paramètres...)
+    :param candidate_depth: Fonction qui indique si un état final peut être atteint après un
+    nombre de transitions donné (par exemple pour une raison de parité). Les autres profondeurs
+    ne sont pas vérifiées. None pour vérifier toutes les profondeurs
+    :param observer: Fonction appelée avec un DepthEvent après chaque profondeur vérifiée
+    :param counters: Un objet Counters mis à jour pendant la résolution
+    :param unrolling: Un dépliage déjà construit (voir Unrolling), à utiliser à la place de
+    State et action_formulas
+    :param interrupt: Un Interrupt permettant d'arrêter la résolution depuis un autre thread
+    (Cancelled est alors levée)
     :return: Un objet de la classe Model ou None si le problème est insatisfiable
     """
+    deadline = None if timeout is None else time() + timeout
+    if unrolling is None:
+        unrolling = Unrolling(State, action_formulas)
 
     states = []
     transitions = []
 
-    solver = Solver()
+    solver = mk_solver()
+    probe = _Probe(solver, observer, counters)
+    if interrupt is not None:
+        interrupt.attach(solver)
 
-    states.append(State(0))
+    states.append(unrolling.state(0))
     solver.add(init_state_predicate(states[0]))
 
-    for i in range(max_nb_transitions):
-        debug(f"Step {i}/{max_nb_transitions}")
-        states.append(State(i + 1))
-        trans = transition(states[i], states[i + 1], action_formulas)
-        transitions.append(trans)
-        solver.add(trans.formula)
-        # sauvegarde de l'état
-        solver.push()
-        # vérification de la propriété sur l'état final
-        solver.add(final_state_predicate(states[i + 1]))
-        status = solver.check()
-        if status == sat:
-            return Solution(
-                z3_model=solver.model(),
-                transitions=transitions,
-                states=states
-            )
-        elif status == unknown:
-            raise AssertionError("Z3 formula satisfiability could not be determined")
-        elif status == unsat:
-            pass
-        else:
-            raise AssertionError("Cas non prévu")
-        # on remet le solver à l'état d'avant
-        solver.pop()
-    else:
+    try:
+        for i in range(max_nb_transitions):
+            debug(f"Step {i}/{max_nb_transitions}")
+            states.append(unrolling.state(i + 1))
+            trans = unrolling.transition(i)
+            transitions.append(trans)
+            solver.add(trans.formula)
+            if candidate_depth is not None and not candidate_depth(i + 1):
+                continue
+            probe.start(i + 1)
+            # sauvegarde de l'état
+            solver.push()
+            # vérification de la propriété sur l'état final
+            solver.add(final_state_predicate(states[i + 1]))
+            status = _check(solver, deadline, interrupt, probe)
+            probe.end(status)
+            if status == sat:
+                return Solution(
+                    z3_model=solver.model(),
+                    transitions=transitions,
+                    states=states
+                )
+            # on remet le solver à l'état d'avant
+            solver.pop()
         # Problème non satisfiable
         return None
+    finally:
+        probe.close()
 
 
-def _bounded_models(State, action_formulas, init_state_predicate):
+def _strictly_less(criterion, value: int):
     """
-    Génère des états et des formules sans l'état final pour faciliter
-    l'écriture de bmc_approx.
-    :param State:
-    :param action_formulas:
-    :param init_state_predicate:
-    :return: Generator[formulas, states, transitions]
+    Contrainte criterion < value, la comparaison étant non signée pour les bitvecteurs
+    (comme le fait Optimize.minimize)
     """
-    states = [State(0)]
-    transitions = []
-    formulas = [init_state_predicate(states[0])]
-    i = 0
+    if is_bv(criterion):
+        return ULT(criterion, value)
+    return criterion < value
+
+
+def _at_most(criterion, value: int):
+    """
+    Contrainte criterion <= value (voir _strictly_less)
+    """
+    if is_bv(criterion):
+        return ULE(criterion, value)
+    return criterion <= value
+
+
+def _check(solver, deadline: Optional[float], interrupt: Optional[Interrupt] = None,
+           probe: Optional[_Probe] = None, assumptions: Sequence[z3.BoolRef] = ()):
+    """
+    Appelle solver.check() (sous les hypothèses assumptions) dans la limite du temps restant
+    :return: sat ou unsat (TimeoutError ou AssertionError si le solveur ne conclut pas,
+    Cancelled si la résolution a été interrompue)
+    """
+    if interrupt is not None and interrupt.cancelled:
+        raise Cancelled()
+    _set_timeout(solver, deadline)
+    begin = time()
+    status = solver.check(*assumptions)
+    if probe is not None:
+        probe.checked(status, time() - begin)
+    if status == unknown:
+        if interrupt is not None and interrupt.cancelled:
+            raise Cancelled()
+        if probe is not None:
+            probe.end(status)
+        _raise_unknown(solver)
+    return status
+
+
+def _descend(solver, criterion, deadline: Optional[float], lower_bound: int = 0,
+             interrupt: Optional[Interrupt] = None, probe: Optional[_Probe] = None,
+             bisect: bool = False):
+    """
+    Minimise criterion sous les contraintes du solveur par descente : tant qu'un modèle
+    existe on exige un critère strictement plus petit. Sur les bitvecteurs c'est bien plus
+    rapide qu'Optimize.minimize. Les contraintes ajoutées restent dans le scope courant du
+    solveur (à retirer avec pop).
+    :param lower_bound: valeur en dessous de laquelle le critère ne peut pas descendre,
+    la descente s'arrête dès qu'elle est atteinte
+    :param bisect: True pour une recherche dichotomique : on demande un critère au plus égal
+    au milieu de l'intervalle restant, sous forme d'hypothèse (solver.check(hypothèse)) de
+    sorte qu'un échec n'ajoute que la contrainte contraire
+    :return: un générateur des modèles successifs et de leur critère (de plus en plus petit)
+    """
+    if _check(solver, deadline, interrupt, probe) != sat:
+        return
+    low = lower_bound
     while True:
-        states = states + [State(i + 1)]
-        trans = transition(states[i], states[i + 1], action_formulas)
-        transitions = transitions + [trans]
-        formulas = formulas + [trans.formula]
-        yield formulas, states, transitions
-        i += 1
+        model = solver.model()
+        score = model.eval(criterion, model_completion=True).as_long()
+        yield model, score
+        solver.add(_strictly_less(criterion, score))
+        while True:
+            if score <= low:
+                return
+            if not bisect:
+                if _check(solver, deadline, interrupt, probe) != sat:
+                    return
+                break
+            middle = (low + score - 1) // 2
+            if _check(solver, deadline, interrupt, probe, [_at_most(criterion, middle)]) == sat:
+                break
+            solver.add(Not(_at_most(criterion, middle)))
+            low = middle + 1
+
+
+def _minimize(solver, criterion, deadline: Optional[float], probe: Optional[_Probe] = None,
+              interrupt: Optional[Interrupt] = None, bisect: bool = False):
+    """
+    Voir _descend
+    :return: le meilleur modèle et la valeur du critère, (None, None) si insatisfiable
+    """
+    model, score = None, None
+    for model, score in _descend(solver, criterion, deadline, interrupt=interrupt, probe=probe,
+                                 bisect=bisect):
+        pass
+    return model, score
+
+
+class CubeChecker:
+    """
+    Bounded model checking sous hypothèses, pour répartir la recherche en cubes (voir
+    cubes.py) : un même solveur vérifie à une profondeur donnée plusieurs cubes (conjonctions
+    de littéraux, par exemple les booléens actions_done d'un préfixe de la trace), de sorte
+    que les clauses apprises sur un cube servent aux suivants
+    :param unrolling: Le dépliage des transitions (voir Unrolling)
+    :param init_state_predicate: voir bmc
+    :param final_state_predicate: voir bmc
+    :param mk_solver: voir bmc
+    """
+
+    def __init__(self, unrolling: Unrolling, init_state_predicate, final_state_predicate,
+                 mk_solver: Callable[[], Solver] = Solver):
+        self.unrolling = unrolling
+        self.final_state_predicate = final_state_predicate
+        self.solver = mk_solver()
+        self.solver.add(init_state_predicate(unrolling.state(0)))
+        # profondeur dont le prédicat final est dans le solveur
+        self.depth = None
+
+    def check(self, depth: int, assumptions: Sequence[z3.BoolRef],
+              deadline: Optional[float] = None) -> Optional[Solution]:
+        """
+        Cherche une trace de depth transitions qui mène à un état final sous les hypothèses
+        assumptions. Les profondeurs successives ne doivent pas décroître.
+        :param deadline: instant (time()) au-delà duquel TimeoutError est levée
+        :return: Un objet de la classe Model ou None s'il n'y a pas de telle trace
+        """
+        if depth != self.depth:
+            if self.depth is not None:
+                if depth < self.depth:
+                    raise ValueError(f"Profondeur {depth} après la profondeur {self.depth}")
+                self.solver.pop()
+            for i in range(self.depth or 0, depth):
+                self.solver.add(self.unrolling.transition(i).formula)
+            self.solver.push()
+            self.solver.add(self.final_state_predicate(self.unrolling.state(depth)))
+            self.depth = depth
+        if _check(self.solver, deadline, assumptions=assumptions) == unsat:
+            return None
+        return Solution(
+            z3_model=self.solver.model(),
+            transitions=[self.unrolling.transition(i) for i in range(depth)],
+            states=[self.unrolling.state(i) for i in range(depth + 1)]
+        )
+
+
+def bmc_approx_iter(State, action_formulas, init_state_predicate, final_state_approx_constraints,
+                    max_nb_transitions, timeout: Optional[float] = None,
+                    mk_solver: Callable[[], Solver] = Solver,
+                    candidate_depth: Optional[Callable[[int], bool]] = None,
+                    lower_bound: int = 0, interrupt: Optional[Interrupt] = None,
+                    observer: Optional[Callable[[DepthEvent], None]] = None,
+                    counters: Optional[Counters] = None,
+                    unrolling: Optional[Unrolling] = None,
+                    upper_bound: Optional[int] = None, bisect: bool = False
+                    ) -> Iterator[Solution]:
+    """
+    Bounded Model Checking avec approximation, en continu : produit une solution à chaque fois
+    que le meilleur écart trouvé s'améliore, y compris au cours de la minimisation à une
+    profondeur donnée. La dernière solution produite est celle que renvoie bmc_approx.
+    :param lower_bound: Valeur minimale connue du critère (0 par défaut) : la recherche
+    s'arrête dès qu'une solution l'atteint, celle-ci étant alors optimale
+    :param interrupt: un Interrupt permettant d'arrêter la recherche depuis un autre thread,
+    le générateur se termine alors sans erreur
+    :param upper_bound: Valeur du critère atteinte par une trace connue, None si aucune ne
+    l'est : les états finaux dont le critère est plus grand sont écartés
+    :param bisect: voir _descend
+    Une fois une solution trouvée, les profondeurs suivantes ne cherchent que des états
+    finaux de critère strictement plus petit : le statut d'une profondeur (voir DepthEvent)
+    est sat si elle améliore le meilleur critère.
+    Les autres paramètres sont ceux de bmc_approx.
+    :return: un générateur de Solution (TimeoutError une fois le temps dépassé)
+    """
+    deadline = None if timeout is None else time() + timeout
+    if unrolling is None:
+        unrolling = Unrolling(State, action_formulas)
+    states = []
+    transitions = []
+    best_score = None
+
+    # Un seul solveur est conservé d'une profondeur à l'autre (comme dans bmc) :
+    # seules les contraintes sur l'état final sont retirées (pop) à chaque étape,
+    # les clauses apprises sur le dépliage des transitions sont donc conservées.
+    solver = mk_solver()
+    probe = _Probe(solver, observer, counters)
+    if interrupt is not None:
+        interrupt.attach(solver)
+
+    states.append(unrolling.state(0))
+    solver.add(init_state_predicate(states[0]))
+
+    try:
+        for i in range(max_nb_transitions):
+            debug(f"Step {i + 1}/{max_nb_transitions}")
+            states.append(unrolling.state(i + 1))
+            trans = unrolling.transition(i)
+            transitions.append(trans)
+            solver.add(trans.formula)
+            if candidate_depth is not None and not candidate_depth(i + 1):
+                continue
+            probe.start(i + 1)
+            found = False
+            # sauvegarde de l'état
+            solver.push()
+            final_state_constraints = final_state_approx_constraints(states[i + 1])
+            solver.add(final_state_constraints['hard'])
+            criterion = final_state_constraints['criterion']
+            if upper_bound is not None:
+                solver.add(_at_most(criterion, upper_bound))
+            if best_score is not None:
+                solver.add(_strictly_less(criterion, best_score))
+            for model, score in _descend(solver, criterion, deadline, lower_bound, interrupt,
+                                         probe, bisect):
+                found = True
+                if best_score is None or score < best_score:
+                    best_score = probe.best_score = score
+                    debug(f"SAT score : {score}")
+                    yield Solution(
+                        z3_model=model,
+                        # copies : les listes continuent de grandir aux profondeurs suivantes
+                        transitions=list(transitions),
+                        states=list(states),
+                        difference=score,
+                    )
+            probe.end(sat if found else unsat)
+            if best_score is not None and best_score <= lower_bound:
+                return
+            # on remet le solver à l'état d'avant
+            solver.pop()
+    except Cancelled:
+        debug("Interrupted")
+    finally:
+        probe.close()
 
 
 def bmc_approx(State, action_formulas, init_state_predicate, final_state_approx_constraints,
-               max_nb_transitions) -> Optional[Solution]:
+               max_nb_transitions, timeout: Optional[float] = None,
+               mk_solver: Callable[[], Solver] = Solver,
+               candidate_depth: Optional[Callable[[int], bool]] = None,
+               observer: Optional[Callable[[DepthEvent], None]] = None,
+               counters: Optional[Counters] = None,
+               unrolling: Optional[Unrolling] = None,
+               interrupt: Optional[Interrupt] = None, lower_bound: int = 0,
+               upper_bound: Optional[int] = None, bisect: bool = False) -> Optional[Solution]:
     """
     Bounded Model Checking avec approximation
     :param State: Une classe décrivant un état du système
@@ -131,36 +555,319 @@ def bmc_approx(State, action_formulas, init_state_predicate, final_state_approx_
         respectées pour que l'état final soit acceptable
         * 'criterion', un critère à minimiser (un entier ou un bitvector) sur l'état final
     :param max_nb_transitions: Borne maximale du nombre de transitions effectués
+    :param timeout: Durée maximale de la résolution en secondes (TimeoutError au-delà),
+    None pour ne pas limiter la durée
+    :param mk_solver: Fonction sans argument qui crée le solveur Z3 utilisé (tactique, paramètres...)
+    :param candidate_depth: Fonction qui indique si un état final peut être atteint après un
+    nombre de transitions donné (par exemple pour une raison de parité). Les autres profondeurs
+    ne sont pas vérifiées. None pour vérifier toutes les profondeurs
+    :param observer: Fonction appelée avec un DepthEvent après chaque profondeur vérifiée
+    :param counters: Un objet Counters mis à jour pendant la résolution
+    :param unrolling: Un dépliage déjà construit (voir Unrolling), à utiliser à la place de
+    State et action_formulas
+    :param interrupt: Un Interrupt permettant d'arrêter la résolution depuis un autre thread
+    (Cancelled est alors levée)
+    :param lower_bound: voir bmc_approx_iter
+    :param upper_bound: voir bmc_approx_iter
+    :param bisect: True pour minimiser le critère par dichotomie plutôt que par descente
+    (voir _descend)
     :return: Un objet de la classe Model ou None si le problème est insatisfiable
     """
     best_model = None
-    for i, (formula, states, transitions) in enumerate(
-            islice(_bounded_models(State, action_formulas, init_state_predicate),
-                   max_nb_transitions)):
-        debug(f"Step {i + 1}/{max_nb_transitions}")
-        solver = Optimize()
-        solver.add(formula)
-        final_state_constraints = final_state_approx_constraints(states[i + 1])
-        solver.add(final_state_constraints['hard'])
-        v = solver.minimize(final_state_constraints['criterion'])
-        status = solver.check()
-        if status == sat:
-            cur_score = v.value().as_long()
-            if best_model == None or best_model.difference > cur_score:
-                best_model = Solution(
-                    z3_model=solver.model(),
-                    transitions=transitions,
-                    states=states,
-                    difference=cur_score,
-                )
-                debug(f"SAT score : {cur_score}")
-            if cur_score == 0:
-                break
-        elif status == unknown:
-            raise AssertionError("Z3 formula satisfiability could not be determined")
-        elif status == unsat:
-            debug("UNSAT")
-            pass
-        else:
-            raise AssertionError("Cas non prévu")
+    for best_model in bmc_approx_iter(State, action_formulas, init_state_predicate,
+                                      final_state_approx_constraints, max_nb_transitions,
+                                      timeout, mk_solver, candidate_depth, lower_bound,
+                                      interrupt, observer, counters, unrolling, upper_bound,
+                                      bisect):
+        pass
+    if interrupt is not None and interrupt.cancelled:
+        raise Cancelled()
     return best_model
+
+
+def bmc_values(State, action_formulas, init_state_predicate, final_state_value, accepted,
+               max_nb_transitions, timeout: Optional[float] = None,
+               mk_solver: Callable[[], Solver] = Solver,
+               candidate_depth: Optional[Callable[[int], bool]] = None,
+               observer: Optional[Callable[[DepthEvent], None]] = None,
+               counters: Optional[Counters] = None,
+               unrolling: Optional[Unrolling] = None,
+               interrupt: Optional[Interrupt] = None) -> Iterator[Tuple[int, Solution]]:
+    """
+    Bounded Model Checking énumérant les valeurs atteignables : à chaque profondeur, tant
+    qu'un état final a une valeur acceptée et pas encore trouvée, on la produit puis on
+    l'exclut (clause de blocage). Un seul solveur sert à toutes les valeurs et à toutes les
+    profondeurs (comme dans bmc), chaque valeur est produite une fois avec la trace la plus
+    courte qui l'atteint.
+    :param final_state_value: Fonction prenant un état et renvoyant un dictionnaire avec deux clés
+        * 'hard' un prédicat (formule Z3) que l'état final doit respecter
+        * 'value' la valeur de l'état final (un entier ou un bitvector)
+    :param accepted: Fonction prenant l'expression de la valeur et renvoyant la contrainte
+    qui caractérise les valeurs cherchées
+    Les autres paramètres sont ceux de bmc.
+    :return: un générateur des couples (valeur, Solution)
+    """
+    deadline = None if timeout is None else time() + timeout
+    if unrolling is None:
+        unrolling = Unrolling(State, action_formulas)
+    states = [unrolling.state(0)]
+    transitions = []
+    found = []
+
+    solver = mk_solver()
+    probe = _Probe(solver, observer, counters)
+    if interrupt is not None:
+        interrupt.attach(solver)
+    solver.add(init_state_predicate(states[0]))
+
+    try:
+        for i in range(max_nb_transitions):
+            debug(f"Step {i + 1}/{max_nb_transitions}")
+            states.append(unrolling.state(i + 1))
+            trans = unrolling.transition(i)
+            transitions.append(trans)
+            solver.add(trans.formula)
+            if candidate_depth is not None and not candidate_depth(i + 1):
+                continue
+            probe.start(i + 1)
+            solver.push()
+            final_state = final_state_value(states[i + 1])
+            value = final_state['value']
+            solver.add(final_state['hard'], accepted(value))
+            # les valeurs trouvées aux profondeurs précédentes sont exclues
+            for number in found:
+                solver.add(value != number)
+            status = unsat
+            while _check(solver, deadline, interrupt, probe) == sat:
+                status = sat
+                model = solver.model()
+                number = model.eval(value, model_completion=True).as_long()
+                found.append(number)
+                yield number, Solution(
+                    z3_model=model,
+                    transitions=list(transitions),
+                    states=list(states),
+                )
+                solver.add(value != number)
+            probe.end(status)
+            solver.pop()
+    finally:
+        probe.close()
+
+
+def bmc_all(State, action_formulas, init_state_predicate, final_state_predicate,
+            max_nb_transitions, timeout: Optional[float] = None,
+            mk_solver: Callable[[], Solver] = Solver,
+            candidate_depth: Optional[Callable[[int], bool]] = None,
+            observer: Optional[Callable[[DepthEvent], None]] = None,
+            counters: Optional[Counters] = None,
+            unrolling: Optional[Unrolling] = None,
+            interrupt: Optional[Interrupt] = None) -> Iterator[Solution]:
+    """
+    Bounded Model Checking énumérant toutes les traces qui atteignent un état final, par
+    longueur croissante : chaque trace trouvée est exclue par une clause de blocage sur les
+    booléens actions_done de ses transitions. Un seul solveur sert à toutes les traces et à
+    toutes les profondeurs (les clauses de blocage d'une profondeur sont retirées avec pop).
+    Les paramètres sont ceux de bmc.
+    :return: un générateur de Solution
+    """
+    deadline = None if timeout is None else time() + timeout
+    if unrolling is None:
+        unrolling = Unrolling(State, action_formulas)
+    states = [unrolling.state(0)]
+    transitions = []
+
+    solver = mk_solver()
+    probe = _Probe(solver, observer, counters)
+    if interrupt is not None:
+        interrupt.attach(solver)
+    solver.add(init_state_predicate(states[0]))
+
+    try:
+        for i in range(max_nb_transitions):
+            debug(f"Step {i + 1}/{max_nb_transitions}")
+            states.append(unrolling.state(i + 1))
+            trans = unrolling.transition(i)
+            transitions.append(trans)
+            solver.add(trans.formula)
+            if candidate_depth is not None and not candidate_depth(i + 1):
+                continue
+            probe.start(i + 1)
+            solver.push()
+            solver.add(final_state_predicate(states[i + 1]))
+            status = unsat
+            while _check(solver, deadline, interrupt, probe) == sat:
+                status = sat
+                model = solver.model()
+                yield Solution(
+                    z3_model=model,
+                    transitions=list(transitions),
+                    states=list(states),
+                )
+                # au moins une des actions de la trace doit changer
+                solver.add(Or([Not(transition.actions_done[transition.string(model)])
+                               for transition in transitions]))
+            probe.end(status)
+            solver.pop()
+    finally:
+        probe.close()
+
+
+STOP = "stop"
+
+
+def _unroll_with_stop(solver, State, action_formulas, init_state_predicate, stop_formula,
+                      max_nb_transitions, candidate_depth):
+    """
+    Déplie max_nb_transitions transitions d'un coup en ajoutant une action "stop" qui laisse
+    l'état inchangé. Une fois choisie, l'action stop l'est jusqu'à la fin de la trace, de sorte
+    que l'état final de la trace dépliée est celui atteint au premier stop : la longueur de la
+    trace est libre. Le premier stop n'est permis qu'aux profondeurs candidates.
+    :return: les états et les transitions
+    """
+    actions = {**action_formulas, STOP: stop_formula}
+    states = [State(0)]
+    transitions = []
+    solver.add(init_state_predicate(states[0]))
+    for i in range(max_nb_transitions):
+        states.append(State(i + 1))
+        trans = transition(states[i], states[i + 1], actions, i)
+        stopped = trans.actions_done[STOP]
+        solver.add(trans.formula)
+        if transitions:
+            # stop est absorbant
+            solver.add(Implies(transitions[-1].actions_done[STOP], stopped))
+        if candidate_depth is not None and not candidate_depth(i):
+            # on ne peut pas s'arrêter pour la première fois après i transitions
+            solver.add(Implies(stopped, transitions[-1].actions_done[STOP])
+                       if transitions else Not(stopped))
+        transitions.append(trans)
+    return states, transitions
+
+
+def _length(model, transitions) -> int:
+    """
+    Nombre de transitions effectuées avant le premier stop
+    """
+    return sum(1 for trans in transitions
+               if not is_true(model.eval(trans.actions_done[STOP], model_completion=True)))
+
+
+def _shortest(solver, model, transitions, deadline: Optional[float],
+              probe: Optional[_Probe] = None, interrupt: Optional[Interrupt] = None):
+    """
+    Raccourcit la trace du modèle tant que c'est possible, en exigeant que le stop
+    intervienne plus tôt, afin de renvoyer comme bmc une trace de longueur minimale.
+    Les contraintes ajoutées restent dans le scope courant du solveur.
+    """
+    length = _length(model, transitions)
+    while length > 0:
+        solver.add(transitions[length - 1].actions_done[STOP])
+        if _check(solver, deadline, interrupt, probe) == unsat:
+            break
+        model = solver.model()
+        length = _length(model, transitions)
+    return model
+
+
+def _without_stop(model, states, transitions, difference=0) -> Solution:
+    """
+    Retire de la solution les transitions stop (toutes en fin de trace)
+    """
+    length = _length(model, transitions)
+    return Solution(
+        z3_model=model,
+        transitions=transitions[:length],
+        states=states[:length + 1],
+        difference=difference,
+    )
+
+
+def bmc_single(State, action_formulas, init_state_predicate, final_state_predicate,
+               max_nb_transitions, stop_formula, timeout: Optional[float] = None,
+               mk_solver: Callable[[], Solver] = Solver,
+               candidate_depth: Optional[Callable[[int], bool]] = None,
+               observer: Optional[Callable[[DepthEvent], None]] = None,
+               counters: Optional[Counters] = None,
+               interrupt: Optional[Interrupt] = None) -> Optional[Solution]:
+    """
+    Bounded Model Checking en une seule requête : au lieu d'un appel au solveur par profondeur,
+    on déplie une fois toutes les transitions avec une action stop (voir _unroll_with_stop).
+    Une seule requête décide du problème, la trace trouvée est ensuite raccourcie pour
+    renvoyer comme bmc une solution de longueur minimale.
+    :param stop_formula: Fonction prenant deux états et renvoyant la formule Z3 exprimant
+    qu'ils sont égaux
+    Les autres paramètres sont ceux de bmc. L'observateur est appelé une seule fois, pour
+    la profondeur max_nb_transitions.
+    :return: Un objet de la classe Model ou None si le problème est insatisfiable
+    """
+    deadline = None if timeout is None else time() + timeout
+    solver = mk_solver()
+    probe = _Probe(solver, observer, counters)
+    if interrupt is not None:
+        interrupt.attach(solver)
+    try:
+        states, transitions = _unroll_with_stop(solver, State, action_formulas,
+                                                init_state_predicate, stop_formula,
+                                                max_nb_transitions, candidate_depth)
+        probe.start(max_nb_transitions)
+        solver.add(final_state_predicate(states[-1]))
+        status = _check(solver, deadline, interrupt, probe)
+        if status == unsat:
+            probe.end(status)
+            return None
+        model = _shortest(solver, solver.model(), transitions, deadline, probe, interrupt)
+        probe.end(status)
+        return _without_stop(model, states, transitions)
+    finally:
+        probe.close()
+
+
+def bmc_approx_single(State, action_formulas, init_state_predicate,
+                      final_state_approx_constraints, max_nb_transitions, stop_formula,
+                      timeout: Optional[float] = None, mk_solver: Callable[[], Solver] = Solver,
+                      candidate_depth: Optional[Callable[[int], bool]] = None,
+                      observer: Optional[Callable[[DepthEvent], None]] = None,
+                      counters: Optional[Counters] = None,
+                      interrupt: Optional[Interrupt] = None,
+                      upper_bound: Optional[int] = None, bisect: bool = False
+                      ) -> Optional[Solution]:
+    """
+    Bounded Model Checking avec approximation en une seule minimisation : on déplie une fois
+    toutes les transitions avec une action stop (voir _unroll_with_stop) et on minimise le
+    critère sur le dernier état. Comme pour bmc_approx, la trace renvoyée est la plus courte
+    parmi celles qui atteignent le meilleur critère.
+    :param stop_formula: Fonction prenant deux états et renvoyant la formule Z3 exprimant
+    qu'ils sont égaux
+    Les autres paramètres sont ceux de bmc_approx. L'observateur est appelé une seule fois,
+    pour la profondeur max_nb_transitions.
+    :return: Un objet de la classe Model ou None si le problème est insatisfiable
+    """
+    deadline = None if timeout is None else time() + timeout
+    solver = mk_solver()
+    probe = _Probe(solver, observer, counters)
+    if interrupt is not None:
+        interrupt.attach(solver)
+    try:
+        states, transitions = _unroll_with_stop(solver, State, action_formulas,
+                                                init_state_predicate, stop_formula,
+                                                max_nb_transitions, candidate_depth)
+        probe.start(max_nb_transitions)
+        final_state_constraints = final_state_approx_constraints(states[-1])
+        criterion = final_state_constraints['criterion']
+        solver.add(final_state_constraints['hard'])
+        if upper_bound is not None:
+            solver.add(_at_most(criterion, upper_bound))
+        solver.push()
+        model, score = _minimize(solver, criterion, deadline, probe, interrupt, bisect)
+        solver.pop()
+        if model is None:
+            probe.end(unsat)
+            return None
+        probe.best_score = score
+        solver.add(criterion == score)
+        model = _shortest(solver, model, transitions, deadline, probe, interrupt)
+        probe.end(sat)
+        return _without_stop(model, states, transitions, score)
+    finally:
+        probe.close()
@@ -0,0 +1,180 @@
+"""
+Résolution en portfolio : plusieurs configurations (backend, encodage de la pile,
+largeur des bitvecteurs, tactique ou paramètres de Z3) sont lancées en parallèle sur le même jeu, chacune dans
+son propre processus. La première réponse définitive est retenue et les autres
+processus sont arrêtés.
+
+Les configurations gagnantes sont comptées dans `wins` et peuvent être ajoutées à un
+fichier JSONL afin d'ajuster les configurations par défaut.
+"""
+import json
+import logging
+import multiprocessing
+from collections import Counter
+from dataclasses import dataclass
+from queue import Empty
+from time import time
+from typing import Any, Optional, Sequence, Tuple
+
+from chiffres import GameInput, solve
+from search import SearchSolution, portable_solution, replay
+
+
+@dataclass(frozen=True)
+class Configuration:
+    """
+    Une configuration du portfolio
+    :param name: nom de la configuration (celui enregistré lorsqu'elle gagne)
+    :param backend: backend passé à solve ("smt" ou "search")
+    :param encoding: encodage de la pile passé à solve ("array" ou "registers")
+    :param symmetry: True pour ajouter les contraintes de symmetry_breaking
+    :param extra_bits: bits ajoutés à la largeur demandée. Une autre largeur change la
+    sémantique des dépassements, aussi n'est-elle utilisée qu'en résolution exacte sans
+    dépassement, où la réponse peut être vérifiée à la largeur demandée
+    :param tactic: noms des tactiques Z3 composées avec Then, None pour le solveur par défaut
+    :param solver_params: paramètres du solveur Z3, sous forme de couples (nom, valeur)
+    """
+    name: str
+    backend: str = "smt"
+    encoding: str = "array"
+    symmetry: bool = False
+    extra_bits: int = 0
+    tactic: Optional[Tuple[str, ...]] = None
+    solver_params: Tuple[Tuple[str, Any], ...] = ()
+
+    def applicable(self, approx: bool, no_overflow: bool) -> bool:
+        return self.extra_bits == 0 or (not approx and no_overflow)
+
+    def mk_solver(self):
+        from z3 import Solver, Then
+        solver = Then(*self.tactic).solver() if self.tactic else Solver()
+        for name, value in self.solver_params:
+            solver.set(name, value)
+        return solver
+
+
+DEFAULT_PORTFOLIO = (
+    Configuration("search", backend="search"),
+    Configuration("z3"),
+    Configuration("z3-registers", encoding="registers"),
+    Configuration("z3-registers-symmetry", encoding="registers", symmetry=True),
+    Configuration("z3-seed", solver_params=(("random_seed", 7),)),
+    Configuration("z3-no-relevancy", solver_params=(("relevancy", 0),)),
+    Configuration("z3-tactic", tactic=("simplify", "propagate-values", "solve-eqs", "smt")),
+    Configuration("z3-wide", extra_bits=4),
+)
+
+# nombre de victoires de chaque configuration dans ce processus
+wins = Counter()
+
+# intervalle en secondes entre deux vérifications que les processus sont encore en vie
+POLL_INTERVAL = 0.1
+
+
+def _run(configuration: Configuration, input: GameInput, approx: bool, no_overflow: bool,
+         bits: int, timeout: Optional[float], results):
+    bits = bits + configuration.extra_bits
+    try:
+        solution = solve(input, approx=approx, no_overflow=no_overflow, bits=bits,
+                         backend=configuration.backend, timeout=timeout,
+                         mk_solver=configuration.mk_solver, encoding=configuration.encoding,
+                         symmetry=configuration.symmetry)
+        results.put((configuration.name, portable_solution(solution, input, no_overflow, bits),
+                     None))
+    except Exception as e:
+        results.put((configuration.name, None, f"{type(e).__name__}: {e}"))
+
+
+def poll_timeout(deadline: Optional[float]) -> float:
+    """
+    Durée d'attente d'une réponse avant de vérifier que les processus sont encore en vie
+    """
+    if deadline is None:
+        return POLL_INTERVAL
+    return max(0.0, min(POLL_INTERVAL, deadline - time()))
+
+
+def _definitive(configuration: Configuration, solution: Optional[SearchSolution],
+                input: GameInput, bits: int) -> bool:
+    """
+    Indique si la réponse d'une configuration est valable à la largeur demandée
+    """
+    if configuration.extra_bits == 0:
+        return True
+    if solution is None:
+        # les traces sans dépassement sur bits bits le sont aussi sur une largeur supérieure
+        return configuration.extra_bits > 0
+    try:
+        replay(input.numbers, solution.actions, bits, no_overflow=True)
+        return True
+    except ValueError:
+        return False
+
+
+def solve_portfolio(input: GameInput, approx: bool, no_overflow: bool, bits: int,
+                    configurations: Sequence[Configuration] = DEFAULT_PORTFOLIO,
+                    timeout: Optional[float] = None, record: Optional[str] = None
+                    ) -> Tuple[Optional[SearchSolution], Optional[str]]:
+    """
+    Résout le problème du "compte est bon" en lançant plusieurs configurations en parallèle
+    :param input: voir solve
+    :param approx: voir solve
+    :param no_overflow: voir solve
+    :param bits: voir solve
+    :param configurations: les configurations à mettre en concurrence
+    :param timeout: Durée maximale de la résolution en secondes (TimeoutError au-delà)
+    :param record: chemin d'un fichier JSONL auquel ajouter la configuration gagnante
+    :return: la solution (ou None si le problème est insatisfiable) et le nom de la
+    configuration gagnante
+    """
+    begin = time()
+    configurations = [c for c in configurations if c.applicable(approx, no_overflow)]
+    by_name = {configuration.name: configuration for configuration in configurations}
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_run, daemon=True,
+                                args=(configuration, input, approx, no_overflow, bits, timeout,
+                                      results))
+        for configuration in configurations
+    ]
+    for process in processes:
+        process.start()
+    deadline = None if timeout is None else begin + timeout
+    pending = {configuration.name: process
+               for configuration, process in zip(configurations, processes)}
+    errors = []
+    try:
+        while pending:
+            # un processus déjà terminé a envoyé sa réponse, s'il en a envoyé une
+            exited = [name for name, process in pending.items() if process.exitcode is not None]
+            try:
+                name, solution, error = results.get(timeout=poll_timeout(deadline))
+            except Empty:
+                if deadline is not None and time() >= deadline:
+                    raise TimeoutError("Temps de résolution dépassé")
+                # arrêté sans réponse (erreur fatale de Z3, manque de mémoire...)
+                for name in exited:
+                    errors.append(f"{name}: processus arrêté (code {pending.pop(name).exitcode})")
+                continue
+            pending.pop(name, None)
+            if error is not None:
+                errors.append(f"{name}: {error}")
+            elif _definitive(by_name[name], solution, input, bits):
+                wins[name] += 1
+                logging.info(f"Portfolio : {name} gagne en {time() - begin:.2f}s")
+                if record is not None:
+                    with open(record, "a") as file:
+                        file.write(json.dumps({
+                            "numbers": input.numbers, "objective": input.objective,
+                            "approx": approx, "no_overflow": no_overflow, "bits": bits,
+                            "winner": name, "elapsed": time() - begin,
+                        }) + "\n")
+                return solution, name
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+    raise AssertionError("Aucune configuration n'a donné de réponse définitive : "
+                         + "; ".join(errors))
@@ -0,0 +1,131 @@
+"""
+Filtres appliqués par solve avant tout appel à Z3.
+
+* si l'objectif est l'une des constantes, la trace d'une seule action push est la solution
+  (exacte, et la plus courte). Ce filtre n'est pas appliqué pour le backend smt, qui renvoie
+  un model_checker.Solution : Z3 trouve cette trace dès la profondeur 1 ;
+* sans dépassement, toute valeur calculée est au plus value_bound(constantes) : si l'objectif
+  est plus grand, la résolution exacte n'a pas de solution et, en résolution approchée,
+  l'écart est au moins la différence (borne inférieure) ;
+* une recherche en faisceau (beam) sur les expressions donne rapidement une trace, donc
+  une borne supérieure de l'écart atteignable, ajoutée comme contrainte sur le critère
+  de bmc_approx. Si elle égale la borne inférieure, l'écart optimal est connu et il ne reste
+  qu'à chercher la trace la plus courte qui l'atteint.
+
+Les écarts sont ceux de final_state_approx_constraints (voir search.distance).
+Le nombre de déclenchements de chaque filtre est compté dans `fired`.
+"""
+from collections import Counter
+from dataclasses import dataclass
+from itertools import permutations
+from typing import List, Optional, Tuple
+
+from search import OPERATIONS, SearchSolution, apply_operation, distance, replay
+
+# nombre de déclenchements de chaque filtre dans ce processus
+fired = Counter()
+
+
+@dataclass
+class Presolve:
+    """
+    Résultat des filtres
+    :param decided: True si la réponse est connue sans appel au solveur
+    :param solution: la réponse lorsqu'elle est connue (None si le problème est insatisfiable)
+    :param lower_bound: l'écart à l'objectif est au moins lower_bound
+    :param upper_bound: écart atteint par une trace connue, None si aucune ne l'est
+    """
+    decided: bool = False
+    solution: Optional[SearchSolution] = None
+    lower_bound: int = 0
+    upper_bound: Optional[int] = None
+
+
+def value_bound(numbers: List[int]) -> int:
+    """
+    Majorant des valeurs calculables sans dépassement : le produit des max(n, 2). Une
+    constante n est au plus max(n, 2) et pour P, Q >= 2, P + Q et PQ sont au plus PQ.
+    """
+    bound = 1
+    for number in numbers:
+        bound *= max(number, 2)
+    return bound
+
+
+def beam(numbers: List[int], objective: int, no_overflow: bool, bits: int, width: int = 16
+         ) -> Optional[Tuple[int, List[str]]]:
+    """
+    Recherche en faisceau : un état est un ensemble d'expressions (valeur et trace) construites
+    sur des constantes distinctes. À chaque étape on combine deux expressions d'un état par une
+    opération et on ne garde que les width états contenant la valeur la plus proche de l'objectif.
+    :return: le meilleur écart trouvé et la trace correspondante (une seule expression),
+    None si aucun écart n'est représentable
+    """
+    best = None
+
+    def closeness(value: int) -> Optional[int]:
+        return distance(value, objective, bits)
+
+    def consider(value: int, actions: Tuple[str, ...]):
+        nonlocal best
+        score = closeness(value)
+        if score is not None and (best is None or (score, len(actions)) < (best[0], len(best[1]))):
+            best = (score, list(actions))
+
+    initial = tuple((number, (f"push_{i}",)) for i, number in enumerate(numbers))
+    for value, actions in initial:
+        consider(value, actions)
+    level = [initial]
+    while level and best is not None and best[0] > 0:
+        candidates = {}
+        for state in level:
+            for i, j in permutations(range(len(state)), 2):
+                (below, below_actions), (top, top_actions) = state[i], state[j]
+                for operation in OPERATIONS:
+                    value = apply_operation(operation, top, below, bits, no_overflow)
+                    if value is None:
+                        continue
+                    actions = below_actions + top_actions + (operation,)
+                    consider(value, actions)
+                    rest = tuple(item for k, item in enumerate(state) if k not in (i, j))
+                    successor = rest + ((value, actions),)
+                    candidates.setdefault(tuple(sorted(item[0] for item in successor)), successor)
+        level = sorted(candidates.values(), key=lambda state: min(
+            (score for score in (closeness(value) for value, _ in state) if score is not None),
+            default=1 << bits))[:width]
+    return best
+
+
+def apply_filters(input, approx: bool, no_overflow: bool, bits: int, beam_width: int = 16,
+                  tile_trace: bool = True) -> Presolve:
+    """
+    Applique les filtres (voir le module) au jeu input, les paramètres sont ceux de solve
+    :param tile_trace: False pour ne pas répondre par la trace d'un seul push lorsque
+    l'objectif est une constante
+    """
+    numbers, objective = input.numbers, input.objective
+    if tile_trace and objective in numbers:
+        fired["objective_tile"] += 1
+        actions = [f"push_{numbers.index(objective)}"]
+        return Presolve(decided=True, solution=SearchSolution(
+            actions=actions, stacks=replay(numbers, actions, bits, no_overflow)))
+
+    result = Presolve()
+    bound = min(value_bound(numbers), (1 << bits) - 1)
+    if no_overflow and bound < objective:
+        fired["magnitude"] += 1
+        if not approx:
+            return Presolve(decided=True)
+        # tant que l'objectif est positif en représentation signée, l'écart à une valeur
+        # qui lui est inférieure n'est pas réduit modulo 2^bits
+        if objective.bit_length() < bits:
+            result.lower_bound = objective - bound
+
+    if approx and beam_width > 0:
+        found = beam(numbers, objective, no_overflow, bits, beam_width)
+        if found is not None:
+            fired["beam"] += 1
+            result.upper_bound = found[0]
+            if result.upper_bound <= result.lower_bound:
+                fired["bounds_meet"] += 1
+    return result
@@ -0,0 +1,190 @@
+"""
+Index précalculé des valeurs atteignables pour tous les tirages du jeu télévisé.
+
+Les plaques du jeu sont fixées (1 à 10 en double, 25, 50, 75 et 100), on en tire six et
+l'objectif est compris entre 100 et 999 : il n'y a que 13243 tirages différents. Pour chacun
+on enregistre l'ensemble des valeurs atteignables entre 0 et 1998 sous forme d'un bitmap.
+Comme chaque plaque est atteignable et vaut au plus 100, la valeur atteignable la plus
+proche d'un objectif inférieur à 1000 est toujours dans cet intervalle : le bitmap suffit
+à décider si le compte est bon et, sinon, à donner le meilleur résultat approché.
+
+Format du fichier (petit boutiste) : un en-tête (MAGIC, bits, no_overflow, nombre de
+tirages) suivi d'un enregistrement de 256 octets par tirage, triés par plaques croissantes :
+les six plaques (un octet chacune) puis le bitmap. Le fichier est lu par mmap et un tirage
+est retrouvé par dichotomie.
+
+La construction est répartie sur un pool de processus et peut être reprise : chaque paquet
+de tirages est écrit dans un fichier du répertoire `<path>.parts` et les paquets déjà
+présents ne sont pas recalculés.
+
+Usage : python3 reachability.py index.bin [--workers 4] [--bits 14] [--overflow]
+"""
+import logging
+import mmap
+import os
+import shutil
+import struct
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import combinations
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from search import reachable_values
+
+STANDARD_TILES = tuple(range(1, 11)) * 2 + (25, 50, 75, 100)
+NB_TILES = 6
+MIN_OBJECTIVE, MAX_OBJECTIVE = 100, 999
+# plus grande valeur du bitmap
+MAX_VALUE = 2 * MAX_OBJECTIVE
+
+MAGIC = b"CEBREACH"
+_HEADER = struct.Struct("<8sHBI")
+_BITMAP_SIZE = (MAX_VALUE + 1 + 7) // 8
+_RECORD_SIZE = NB_TILES + _BITMAP_SIZE
+
+
+def standard_games() -> List[Tuple[int, ...]]:
+    """
+    Tous les tirages de six plaques, chacun sous la forme du tuple trié de ses plaques
+    """
+    return sorted(set(combinations(sorted(STANDARD_TILES), NB_TILES)))
+
+
+def _record(tiles: Tuple[int, ...], no_overflow: bool, bits: int) -> bytes:
+    bitmap = bytearray(_BITMAP_SIZE)
+    for value in reachable_values(list(tiles), no_overflow, bits):
+        if value <= MAX_VALUE:
+            bitmap[value >> 3] |= 1 << (value & 7)
+    return bytes(tiles) + bytes(bitmap)
+
+
+def _build_part(path: str, games: Sequence[Tuple[int, ...]], no_overflow: bool, bits: int):
+    # écriture dans un fichier temporaire puis renommage : un paquet interrompu
+    # n'est jamais pris pour un paquet terminé
+    with open(path + ".tmp", "wb") as file:
+        for tiles in games:
+            file.write(_record(tiles, no_overflow, bits))
+    os.replace(path + ".tmp", path)
+
+
+def build_index(path: str, games: Optional[Iterable[Sequence[int]]] = None,
+                workers: Optional[int] = None, chunk_size: int = 256,
+                no_overflow: bool = True, bits: int = 14):
+    """
+    Construit le fichier d'index
+    :param path: chemin du fichier d'index
+    :param games: les tirages à indexer (six plaques chacun), par défaut standard_games()
+    :param workers: nombre de processus (par défaut le nombre de coeurs)
+    :param chunk_size: nombre de tirages par paquet (unité de reprise)
+    :param no_overflow: voir solve, l'index n'est utilisé que pour cette valeur
+    :param bits: voir solve, l'index n'est utilisé que pour cette largeur
+    """
+    if bits <= MAX_VALUE.bit_length():
+        # les écarts à l'objectif (au plus MAX_OBJECTIVE) doivent être représentables
+        # comme entiers signés (cf. search.distance)
+        raise ValueError(f"L'index nécessite au moins {MAX_VALUE.bit_length() + 1} bits")
+    games = standard_games() if games is None else sorted({tuple(sorted(g)) for g in games})
+    for tiles in games:
+        if len(tiles) != NB_TILES or not all(0 <= tile <= 255 for tile in tiles):
+            raise ValueError(f"Tirage non indexable : {tiles}")
+    parts = path + ".parts"
+    os.makedirs(parts, exist_ok=True)
+    chunks = [games[i:i + chunk_size] for i in range(0, len(games), chunk_size)]
+    part_paths = [os.path.join(parts, f"{i:05d}.bin") for i in range(len(chunks))]
+    todo = [i for i, part_path in enumerate(part_paths) if not os.path.exists(part_path)]
+    logging.info(f"Index : {len(chunks) - len(todo)}/{len(chunks)} paquets déjà construits")
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(_build_part, part_paths[i], chunks[i], no_overflow, bits)
+                   for i in todo]
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            logging.info(f"Index : paquet {done}/{len(todo)} construit")
+
+    with open(path + ".tmp", "wb") as file:
+        file.write(_HEADER.pack(MAGIC, bits, no_overflow, len(games)))
+        for part_path in part_paths:
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, file)
+    os.replace(path + ".tmp", path)
+    shutil.rmtree(parts)
+
+
+class ReachabilityIndex:
+    """
+    Lecture d'un index construit par build_index
+    :param path: chemin du fichier d'index
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.bits, no_overflow, self.size = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} n'est pas un index de valeurs atteignables")
+        self.no_overflow = bool(no_overflow)
+
+    def __len__(self):
+        return self.size
+
+    def _bitmap(self, numbers: Sequence[int]) -> Optional[bytes]:
+        if len(numbers) != NB_TILES or not all(0 <= number <= 255 for number in numbers):
+            return None
+        key = bytes(sorted(numbers))
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            offset = _HEADER.size + middle * _RECORD_SIZE
+            tiles = self._mmap[offset:offset + NB_TILES]
+            if tiles == key:
+                return self._mmap[offset + NB_TILES:offset + _RECORD_SIZE]
+            if tiles < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def covers(self, numbers: Sequence[int], objective: int, no_overflow: bool,
+               bits: int) -> bool:
+        """
+        Indique si l'index permet de répondre pour ce jeu et cette sémantique
+        """
+        return (no_overflow == self.no_overflow and bits == self.bits
+                and 0 <= objective <= MAX_OBJECTIVE and self._bitmap(numbers) is not None)
+
+    def reachable(self, numbers: Sequence[int], value: int) -> bool:
+        """
+        Indique si value est atteignable avec les constantes numbers
+        """
+        bitmap = self._bitmap(numbers)
+        if bitmap is None or not 0 <= value <= MAX_VALUE:
+            raise KeyError(f"Hors de l'index : {list(numbers)}, {value}")
+        return bool(bitmap[value >> 3] >> (value & 7) & 1)
+
+    def closest(self, numbers: Sequence[int], objective: int) -> int:
+        """
+        Valeur atteignable la plus proche de objective (la plus petite en cas d'égalité)
+        """
+        bitmap = self._bitmap(numbers)
+        if bitmap is None or not 0 <= objective <= MAX_OBJECTIVE:
+            raise KeyError(f"Hors de l'index : {list(numbers)}, {objective}")
+        for difference in range(MAX_VALUE + 1):
+            for value in (objective - difference, objective + difference):
+                if 0 <= value <= MAX_VALUE and bitmap[value >> 3] >> (value & 7) & 1:
+                    return value
+        raise AssertionError("Aucune valeur atteignable dans l'index")
+
+    def close(self):
+        self._mmap.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--bits", type=int, default=14)
+    parser.add_argument("--overflow", action="store_true", help="autorise les dépassements")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    build_index(args.path, workers=args.workers, no_overflow=not args.overflow, bits=args.bits)
@@ -0,0 +1,447 @@
+"""
+Résolution du "compte est bon" par recherche directe, sans passer par Z3.
+
+On calcule par programmation dynamique, pour chaque sous-ensemble de constantes
+(représenté par un masque de bits), l'ensemble des valeurs que l'on peut obtenir en
+utilisant exactement ces constantes. Les sous-ensembles sont traités par taille
+croissante, ce qui revient à explorer les traces par longueur croissante comme le
+fait le bounded model checking (une trace utilisant k constantes a 2k - 1 actions).
+
+La sémantique des actions est la même que celle des formules de `chiffres.py`
+(entiers non signés sur `bits` bits, dépassements interdits ou non) de sorte que
+les résultats peuvent être comparés à ceux du backend SMT.
+"""
+from array import array
+from dataclasses import dataclass
+from time import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+OPERATIONS = ("add", "sub", "mult", "div")
+
+
+@dataclass
+class GameInput:
+    """
+    Description du problème
+    :example: GameInput(numbers= [8, 10, 2, 1, 5, 50], objective=899)
+    """
+    numbers: List[int]
+    objective: int
+
+
+def _encode_action(action: str) -> int:
+    if action.startswith("push_"):
+        return len(OPERATIONS) + int(action[len("push_"):])
+    return OPERATIONS.index(action)
+
+
+def _decode_action(code: int) -> str:
+    return OPERATIONS[code] if code < len(OPERATIONS) else f"push_{code - len(OPERATIONS)}"
+
+
+def _pack(values: List[int]):
+    """
+    Les valeurs dans le tableau du plus petit type qui les contient (un tuple au-delà de 64 bits)
+    """
+    largest = max(values, default=0)
+    for typecode in "BHIQ":
+        if largest >> (8 * array(typecode).itemsize) == 0:
+            return array(typecode, values)
+    return tuple(values)
+
+
+class SearchSolution:
+    """
+    Solution sans référence à Z3, produite par la recherche directe ou extraite une fois pour
+    toutes d'un modèle (voir portable_solution). Elle expose la même interface que
+    model_checker.Solution (actions_effectuees, difference) et se transmet entre processus
+    (pickle) ou se garde en grand nombre à faible coût : les actions sont codées par de petits
+    entiers (l'indice dans OPERATIONS, puis len(OPERATIONS) + i pour push_i) et les piles
+    sont mises bout à bout dans un tableau d'entiers.
+    :param actions: la séquence des noms d'actions (add, sub, mult, div, push_i)
+    :param stacks: la pile de chaque état, état initial compris
+    :param difference: l'écart à l'objectif (0 pour une solution exacte)
+    """
+    __slots__ = ("_actions", "_heights", "_values", "result", "difference")
+
+    def __init__(self, actions: List[str], stacks: List[List[int]], difference: int = 0):
+        self._actions = bytes(_encode_action(action) for action in actions)
+        self._heights = bytes(len(stack) for stack in stacks)
+        self._values = _pack([value for stack in stacks for value in stack])
+        self.result = stacks[-1][0] if stacks and stacks[-1] else None
+        self.difference = difference
+
+    @property
+    def actions(self) -> List[str]:
+        return [_decode_action(code) for code in self._actions]
+
+    @property
+    def stacks(self) -> List[List[int]]:
+        stacks, start = [], 0
+        for height in self._heights:
+            stacks.append(list(self._values[start:start + height]))
+            start += height
+        return stacks
+
+    def actions_effectuees(self):
+        return map(_decode_action, self._actions)
+
+    def resulting_number(self) -> int:
+        return self.result
+
+    def __eq__(self, other):
+        if not isinstance(other, SearchSolution):
+            return NotImplemented
+        return (self._actions, self._heights, tuple(self._values), self.difference) == \
+            (other._actions, other._heights, tuple(other._values), other.difference)
+
+    __hash__ = None
+
+    def __getstate__(self):
+        values = self._values
+        if isinstance(values, array):
+            values = (values.typecode, values.tobytes())
+        return self._actions, self._heights, values, self.result, self.difference
+
+    def __setstate__(self, state):
+        self._actions, self._heights, values, self.result, self.difference = state
+        if isinstance(values[0], str):
+            typecode, data = values
+            values = array(typecode)
+            values.frombytes(data)
+        self._values = values
+
+    def __repr__(self):
+        return (f"SearchSolution(actions={self.actions}, stacks={self.stacks}, "
+                f"difference={self.difference})")
+
+
+def apply_operation(action: str, top: int, below: int, bits: int, no_overflow: bool
+                    ) -> Optional[int]:
+    """
+    Applique une opération aux deux éléments au sommet de la pile
+    :param action: add, sub, mult ou div
+    :param top: l'élément au sommet de la pile
+    :param below: l'élément juste en dessous
+    :param bits: le nombre de bits des entiers (non signés)
+    :param no_overflow: vrai si on interdit les overflow faux sinon
+    :return: le résultat ou None si l'action n'est pas permise
+    """
+    modulo = 1 << bits
+    if action == "sub":
+        return top - below if top >= below else None
+    if action == "div":
+        # le quotient doit être exact (cf. div_formula)
+        if below == 0 or top % below != 0:
+            return None
+        return top // below
+    result = top + below if action == "add" else top * below
+    if result >= modulo:
+        if no_overflow:
+            return None
+        result %= modulo
+    return result
+
+
+def distance(value: int, target: int, bits: int) -> Optional[int]:
+    """
+    Distance entre value et target telle que calculée par final_state_approx_constraints :
+    la différence modulo 2^bits est interprétée comme un entier signé.
+    :return: la distance ou None si elle n'est pas représentable (différence égale à -2^(bits-1))
+    """
+    modulo = 1 << bits
+    difference = (value - target) % modulo
+    if difference > modulo // 2:
+        difference = modulo - difference
+    if difference == modulo // 2:
+        return None
+    return difference
+
+
+def check_bits(numbers: Iterable[int], objectives: Iterable[int], bits: Union[int, str]):
+    """
+    Vérifie que les constantes et les objectifs sont représentables sur bits bits (ValueError
+    sinon). Avec bits="auto" (voir chiffres.solve), la largeur est choisie assez grande.
+    """
+    if bits == "auto":
+        return
+    for number in numbers:
+        if number.bit_length() > bits:
+            raise ValueError(f"{number} n'est pas représentable sur {bits} bits")
+    for objective in objectives:
+        if objective.bit_length() > bits:
+            raise ValueError(f"L'objectif à atteindre {objective} n'est pas représentable sur "
+                             f"{bits} bits")
+
+
+def countdown(timeout: Optional[float]) -> Callable[[], Optional[float]]:
+    """
+    Délai de timeout secondes à partir de maintenant
+    :return: une fonction qui donne le temps restant (None sans délai) et lève TimeoutError
+    une fois le délai expiré
+    """
+    deadline = None if timeout is None else time() + timeout
+
+    def remaining() -> Optional[float]:
+        if deadline is None:
+            return None
+        if deadline <= time():
+            raise TimeoutError("Temps de résolution dépassé")
+        return deadline - time()
+
+    return remaining
+
+
+def safe_bits(input: GameInput, approx: bool) -> int:
+    """
+    Largeur à partir de laquelle aucun dépassement n'est possible : toute valeur calculée
+    à partir d'un ensemble S de constantes est au plus prod(n + 1 pour n dans S) - 1
+    (par récurrence, car (P - 1) + (Q - 1) et (P - 1)(Q - 1) sont au plus PQ - 1).
+    En résolution approchée, un bit de plus permet de représenter tout écart à l'objectif
+    comme entier signé.
+    """
+    bound = 1
+    for number in input.numbers:
+        bound *= number + 1
+    bits = max((bound - 1).bit_length(), input.objective.bit_length())
+    return bits + 1 if approx else bits
+
+
+def replay_bits(input: GameInput, bits: Union[int, str]) -> int:
+    """
+    Largeur à laquelle rejouer les actions d'une solution de solve : avec bits="auto", aucun
+    dépassement n'est possible à la largeur safe_bits
+    """
+    return safe_bits(input, False) if bits == "auto" else bits
+
+
+def replay(numbers: List[int], actions: List[str], bits: int, no_overflow: bool
+           ) -> List[List[int]]:
+    """
+    Effectue une séquence d'actions à partir de l'état initial
+    :return: la pile de chaque état, état initial compris
+    """
+    stacks = [[]]
+    used = set()
+    for action in actions:
+        stack = list(stacks[-1])
+        if action.startswith("push_"):
+            ith = int(action[len("push_"):])
+            if ith in used:
+                raise ValueError(f"La constante {ith} est utilisée deux fois")
+            used.add(ith)
+            stack.append(numbers[ith])
+        else:
+            if len(stack) < 2:
+                raise ValueError(f"{action} nécessite deux éléments dans la pile")
+            top, below = stack.pop(), stack.pop()
+            result = apply_operation(action, top, below, bits, no_overflow)
+            if result is None:
+                raise ValueError(f"{action} n'est pas permise sur {below} et {top}")
+            stack.append(result)
+        stacks.append(stack)
+    return stacks
+
+
+def canonical_expression(numbers: List[int], actions: List[str]):
+    """
+    Forme canonique de l'expression calculée par une trace : les opérandes des additions et
+    des multiplications sont triés et les enchaînements d'une même opération mis à plat.
+    Deux traces qui ne diffèrent que par l'ordre des opérandes d'opérations commutatives
+    ((a + b) + c et c + (b + a) par exemple) ou par l'échange de constantes égales ont donc
+    la même forme.
+    :return: la valeur d'une constante ou un tuple (opération, opérandes...)
+    """
+    stack = []
+    for action in actions:
+        if action.startswith("push_"):
+            stack.append(numbers[int(action[len("push_"):])])
+            continue
+        top, below = stack.pop(), stack.pop()
+        if action in ("add", "mult"):
+            operands = []
+            for operand in (top, below):
+                if isinstance(operand, tuple) and operand[0] == action:
+                    operands.extend(operand[1:])
+                else:
+                    operands.append(operand)
+            stack.append((action, *sorted(operands, key=repr)))
+        else:
+            stack.append((action, top, below))
+    return stack[-1] if len(stack) == 1 else tuple(stack)
+
+
+def portable_solution(solution, input, no_overflow: bool, bits: Union[int, str]
+                      ) -> Optional[SearchSolution]:
+    """
+    Convertit une solution en un objet sans référence à Z3 (qui peut donc être transmis
+    entre processus) en rejouant ses actions
+    :param bits: la largeur passée à solve (voir replay_bits)
+    """
+    if solution is None or isinstance(solution, SearchSolution):
+        return solution
+    actions = list(solution.actions_effectuees())
+    return SearchSolution(
+        actions=actions,
+        stacks=replay(input.numbers, actions, replay_bits(input, bits), no_overflow),
+        difference=solution.difference,
+    )
+
+
+def _canonical_masks(numbers: List[int]) -> List[int]:
+    """
+    Deux sous-ensembles contenant les mêmes valeurs (constantes en double) sont équivalents.
+    On associe à chaque masque le masque équivalent qui utilise, pour chaque valeur,
+    les premières occurrences de cette valeur.
+    """
+    groups: Dict[int, List[int]] = {}
+    for i, number in enumerate(numbers):
+        groups.setdefault(number, []).append(i)
+    canonical = []
+    for mask in range(1 << len(numbers)):
+        canonical_mask = 0
+        for indices in groups.values():
+            count = sum(1 for i in indices if mask >> i & 1)
+            for i in indices[:count]:
+                canonical_mask |= 1 << i
+        canonical.append(canonical_mask)
+    return canonical
+
+
+def _rpn(reachable, mask: int, value: int) -> List[Tuple[str, int]]:
+    """
+    Reconstruit la notation polonaise inverse d'une valeur atteinte, les constantes
+    étant désignées par leur valeur : [("push", valeur) | (opération, résultat)]
+    """
+    how = reachable[mask][value]
+    if how[0] == "push":
+        return [how]
+    action, mask_below, below, mask_top, top = how
+    return _rpn(reachable, mask_below, below) + _rpn(reachable, mask_top, top) + [(action, value)]
+
+
+def _actions(numbers: List[int], rpn: List[Tuple[str, int]]) -> List[str]:
+    """
+    Convertit une notation polonaise inverse en noms d'actions. Les constantes en double
+    sont poussées dans l'ordre de leurs indices.
+    """
+    used = set()
+    actions = []
+    for action, value in rpn:
+        if action == "push":
+            ith = next(i for i, number in enumerate(numbers) if number == value and i not in used)
+            used.add(ith)
+            actions.append(f"push_{ith}")
+        else:
+            actions.append(action)
+    return actions
+
+
+def search(numbers: List[int], objective: int, approx: bool, no_overflow: bool, bits: int,
+           timeout: Optional[float] = None) -> Optional[SearchSolution]:
+    """
+    Résout le problème du "compte est bon" par programmation dynamique sur les sous-ensembles
+    de constantes. Comme bmc (resp. bmc_approx) on renvoie une solution de longueur minimale
+    (resp. la plus courte parmi celles qui minimisent l'écart à l'objectif).
+    :param numbers: la liste des constantes
+    :param objective: le nombre recherché
+    :param approx: True si on recherche le résultat le plus proche, False pour une solution exacte
+    :param no_overflow: True si on interdit les dépassements d'entiers, False sinon
+    :param bits: Nombre de bits des entiers
+    :param timeout: Durée maximale de la recherche en secondes (TimeoutError au-delà),
+    None pour ne pas limiter la durée
+    :return: Un objet SearchSolution ou None si le problème est insatisfiable
+    """
+    deadline = None if timeout is None else time() + timeout
+    n = len(numbers)
+    canonical = _canonical_masks(numbers)
+    # reachable[masque] : valeur -> ("push", valeur) ou (action, masque, valeur, masque, valeur)
+    reachable: Dict[int, Dict[int, tuple]] = {}
+    best = None  # (distance, masque, valeur)
+
+    masks_by_size: List[List[int]] = [[] for _ in range(n + 1)]
+    for mask in range(1, 1 << n):
+        if canonical[mask] == mask:
+            masks_by_size[bin(mask).count("1")].append(mask)
+
+    for size in range(1, n + 1):
+        for mask in masks_by_size[size]:
+            if deadline is not None and time() > deadline:
+                raise TimeoutError("Temps de résolution dépassé")
+            values = reachable[mask] = {}
+            if size == 1:
+                value = numbers[mask.bit_length() - 1]
+                values[value] = ("push", value)
+            else:
+                _combine(reachable, canonical, mask, values, bits, no_overflow)
+            for value in values:
+                if not approx:
+                    if value == objective:
+                        best = (0, mask, value)
+                        break
+                else:
+                    d = distance(value, objective, bits)
+                    if d is not None and (best is None or d < best[0]):
+                        best = (d, mask, value)
+            if best is not None and best[0] == 0:
+                break
+        if best is not None and best[0] == 0:
+            break
+
+    if best is None:
+        return None
+    difference, mask, value = best
+    actions = _actions(numbers, _rpn(reachable, mask, value))
+    return SearchSolution(
+        actions=actions,
+        stacks=replay(numbers, actions, bits, no_overflow),
+        difference=difference,
+    )
+
+
+def reachable_values(numbers: List[int], no_overflow: bool, bits: int) -> Set[int]:
+    """
+    Ensemble de toutes les valeurs que l'on peut obtenir avec une partie des constantes
+    (même sémantique que search, mais sans s'arrêter à un objectif)
+    """
+    n = len(numbers)
+    canonical = _canonical_masks(numbers)
+    reachable: Dict[int, Dict[int, tuple]] = {}
+    for mask in sorted((mask for mask in range(1, 1 << n) if canonical[mask] == mask),
+                       key=lambda mask: bin(mask).count("1")):
+        values = reachable[mask] = {}
+        if mask & (mask - 1) == 0:
+            value = numbers[mask.bit_length() - 1]
+            values[value] = ("push", value)
+        else:
+            _combine(reachable, canonical, mask, values, bits, no_overflow)
+    return {value for values in reachable.values() for value in values}
+
+
+def _combine(reachable, canonical, mask: int, values: Dict[int, tuple], bits: int,
+             no_overflow: bool):
+    """
+    Calcule les valeurs atteignables avec exactement les constantes de mask en combinant
+    les valeurs de deux sous-ensembles disjoints (below, puis top au sommet de la pile).
+    Les résultats égaux à l'une des opérandes (x*1, x/1, x+0, a-b=b...) sont ignorés :
+    ils sont déjà atteignables avec moins de constantes.
+    """
+    seen = set()
+    sub = (mask - 1) & mask
+    while sub:
+        mask_below, mask_top = canonical[sub], canonical[mask ^ sub]
+        sub = (sub - 1) & mask
+        if (mask_below, mask_top) in seen:
+            continue
+        seen.add((mask_below, mask_top))
+        # add et mult sont commutatives : un seul ordre des opérandes suffit
+        commutative = mask_below <= mask_top
+        for below in reachable[mask_below]:
+            for top in reachable[mask_top]:
+                for action in OPERATIONS:
+                    if action in ("add", "mult") and not commutative:
+                        continue
+                    result = apply_operation(action, top, below, bits, no_overflow)
+                    if result is None or result == top or result == below or result in values:
+                        continue
+                    values[result] = (action, mask_below, below, mask_top, top)
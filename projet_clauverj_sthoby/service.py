@@ -0,0 +1,262 @@
+"""
+Service de résolution asynchrone (asyncio) au-dessus de chiffres.solve.
+
+Les résolutions sont exécutées dans un pool de threads dont la taille borne le nombre de
+résolutions simultanées ; les requêtes suivantes attendent leur tour sans bloquer la boucle
+d'événements. Z3 relâche le GIL pendant solver.check() et chaque thread du pool utilise son
+propre contexte Z3 (un contexte ne doit pas être partagé entre threads), dans lequel les
+formules des transitions sont réutilisées d'une résolution à l'autre.
+
+Le délai d'une requête court à partir de son arrivée : le temps restant est donné à Z3
+(timeout) et la résolution est arrêtée par Interrupt dès que plus aucune requête n'en attend
+le résultat (délai expiré ou requête annulée). Deux requêtes identiques en cours sont fusionnées :
+la seconde attend le résultat de la première, dont la résolution garde le délai initial.
+
+Usage : python3 service.py [--http 8080 | --stdin] [--workers 4] [--timeout 30]
+
+En mode --stdin, chaque ligne lue est une requête JSON et chaque réponse est écrite sur une
+ligne, dans l'ordre où les résolutions se terminent (le champ "id" de la requête est repris).
+En mode --http, les requêtes sont envoyées par POST /solve et GET /stats donne l'état du service.
+Exemple de requête : {"id": 1, "numbers": [8, 10, 2, 1, 5, 50], "objective": 899,
+"approx": false, "no_overflow": true, "bits": 14, "timeout": 10, "encoding": "registers"}
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import Dict, Optional
+
+from z3 import Context
+
+from chiffres import GameInput, solve
+from model_checker import Cancelled, Interrupt
+from search import SearchSolution, portable_solution
+
+# paramètres de solve qui peuvent être précisés dans une requête
+OPTIONS = ("backend", "encoding", "symmetry", "engine")
+
+_local = threading.local()
+
+
+def _context() -> Context:
+    """
+    Contexte Z3 du thread courant
+    """
+    if not hasattr(_local, "ctx"):
+        _local.ctx = Context()
+    return _local.ctx
+
+
+def _solve_in_thread(input: GameInput, approx: bool, no_overflow: bool, bits: int,
+                     deadline: Optional[float], interrupt: Interrupt, options: Dict
+                     ) -> Optional[SearchSolution]:
+    timeout = None
+    if deadline is not None:
+        timeout = deadline - time()
+        if timeout <= 0:
+            raise TimeoutError("Temps de résolution dépassé")
+    solution = solve(input, approx=approx, no_overflow=no_overflow, bits=bits, timeout=timeout,
+                     interrupt=interrupt, ctx=_context(), **options)
+    # la solution ne doit plus faire référence au contexte Z3 du thread
+    return portable_solution(solution, input, no_overflow, bits)
+
+
+class _InFlight:
+    """
+    Une résolution en cours et le nombre de requêtes qui en attendent le résultat
+    """
+
+    def __init__(self):
+        self.interrupt = Interrupt()
+        self.waiters = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class SolveService:
+    """
+    Résolutions asynchrones, en nombre limité, avec délais, annulation et fusion des
+    requêtes identiques
+    :param workers: nombre maximal de résolutions simultanées (par défaut le nombre de coeurs)
+    :param timeout: délai par défaut d'une requête en secondes, None pour ne pas en imposer
+    """
+
+    def __init__(self, workers: Optional[int] = None, timeout: Optional[float] = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.coalesced = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix="solve")
+        self._semaphore = asyncio.Semaphore(self.workers)
+        self._in_flight: Dict[tuple, _InFlight] = {}
+
+    def stats(self) -> Dict:
+        return {"workers": self.workers, "in_flight": len(self._in_flight),
+                "coalesced": self.coalesced}
+
+    async def solve(self, input: GameInput, approx: bool, no_overflow: bool, bits: int,
+                    timeout: Optional[float] = None, **options) -> Optional[SearchSolution]:
+        """
+        Comme chiffres.solve, sans bloquer la boucle d'événements
+        :param timeout: délai de la requête en secondes (TimeoutError au-delà), par défaut
+        celui du service
+        :param options: autres paramètres de solve (voir OPTIONS)
+        :return: la solution (sans référence à Z3) ou None si le problème est insatisfiable
+        """
+        timeout = self.timeout if timeout is None else timeout
+        key = (tuple(input.numbers), input.objective, approx, no_overflow, bits,
+               tuple(sorted(options.items())))
+        entry = self._in_flight.get(key)
+        if entry is None:
+            entry = self._in_flight[key] = _InFlight()
+            entry.task = asyncio.ensure_future(self._run(key, entry, input, approx, no_overflow,
+                                                         bits, timeout, options))
+            # l'erreur d'une résolution que plus personne n'attend est ignorée
+            entry.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        else:
+            self.coalesced += 1
+        entry.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry.task), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Temps de résolution dépassé")
+        finally:
+            entry.waiters -= 1
+            if entry.waiters == 0 and not entry.task.done():
+                # plus personne n'attend ce résultat : la résolution est abandonnée
+                entry.interrupt.cancel()
+                if self._in_flight.get(key) is entry:
+                    del self._in_flight[key]
+
+    async def _run(self, key: tuple, entry: _InFlight, input: GameInput, approx: bool,
+                   no_overflow: bool, bits: int, timeout: Optional[float], options: Dict):
+        deadline = None if timeout is None else time() + timeout
+        try:
+            async with self._semaphore:
+                if entry.interrupt.cancelled:
+                    raise Cancelled()
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._executor, _solve_in_thread, input, approx, no_overflow, bits,
+                    deadline, entry.interrupt, options)
+        finally:
+            if self._in_flight.get(key) is entry:
+                del self._in_flight[key]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+async def handle(service: SolveService, request: Dict) -> Dict:
+    """
+    Traite une requête (voir l'exemple du module)
+    :return: la réponse, dont le champ status vaut sat, unsat, timeout, cancelled ou error
+    """
+    begin = time()
+    response = {"id": request.get("id")}
+    try:
+        input = GameInput(numbers=[int(number) for number in request["numbers"]],
+                          objective=int(request["objective"]))
+        solution = await service.solve(
+            input, approx=bool(request.get("approx", False)),
+            no_overflow=bool(request.get("no_overflow", True)),
+            bits=int(request.get("bits", 14)), timeout=request.get("timeout"),
+            **{option: request[option] for option in OPTIONS if option in request})
+        if solution is None:
+            response["status"] = "unsat"
+        else:
+            response.update(status="sat", result=solution.resulting_number(),
+                            difference=solution.difference, actions=solution.actions)
+    except TimeoutError:
+        response["status"] = "timeout"
+    except Cancelled:
+        response["status"] = "cancelled"
+    except Exception as e:
+        response.update(status="error", error=f"{type(e).__name__}: {e}")
+    response["elapsed"] = time() - begin
+    return response
+
+
+async def serve_stdin(service: SolveService):
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def answer(line: str):
+        try:
+            response = await handle(service, json.loads(line))
+        except json.JSONDecodeError as e:
+            response = {"id": None, "status": "error", "error": f"JSONDecodeError: {e}"}
+        print(json.dumps(response), flush=True)
+
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        if line.strip():
+            task = asyncio.ensure_future(answer(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+
+async def _http_connection(service: SolveService, reader: asyncio.StreamReader,
+                           writer: asyncio.StreamWriter):
+    try:
+        method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        if method == "POST" and path == "/solve":
+            code, response = 200, await handle(service, json.loads(body))
+        elif method == "GET" and path == "/stats":
+            code, response = 200, service.stats()
+        else:
+            code, response = 404, {"status": "error", "error": f"{method} {path} inconnu"}
+    except (ValueError, asyncio.IncompleteReadError) as e:
+        code, response = 400, {"status": "error", "error": f"{type(e).__name__}: {e}"}
+    payload = json.dumps(response).encode()
+    writer.write(f"HTTP/1.1 {code} {'OK' if code == 200 else 'Error'}\r\n"
+                 f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                 f"Connection: close\r\n\r\n".encode() + payload)
+    await writer.drain()
+    writer.close()
+
+
+async def serve_http(service: SolveService, host: str, port: int):
+    server = await asyncio.start_server(
+        lambda reader, writer: _http_connection(service, reader, writer), host, port)
+    print(f"Service à l'écoute sur http://{host}:{port}", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--http", type=int, metavar="PORT")
+    mode.add_argument("--stdin", action="store_true")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--timeout", type=float, help="délai par défaut, en secondes")
+    args = parser.parse_args()
+
+    async def main():
+        service = SolveService(args.workers, args.timeout)
+        try:
+            if args.http is not None:
+                await serve_http(service, args.host, args.http)
+            else:
+                await serve_stdin(service)
+        finally:
+            service.close()
+
+    asyncio.run(main())
@@ -1,5 +1,32 @@
-from chiffres import solve, solution_resulting_number
+from chiffres import solve, solve_all, solve_iter, solve_targets, solution_resulting_number, \
+    GameInput, narrow_bits, safe_bits, transition_system, init_predicate, odd_depth, \
+    final_state_approx_constraints
+from model_checker import Cancelled, Counters, Interrupt, bmc_approx
+from functools import partial
+from z3 import Context
 from games import *
+from batch import solve_many
+from portfolio import solve_portfolio, Configuration
+from cache import SolutionCache
+from reachability import build_index, ReachabilityIndex
+from service import SolveService, handle
+from cubes import cubes
+import cubes as cubes_module
+from presolve import fired, beam
+from export import export, run_solver
+from search import SearchSolution, canonical_expression, distance, portable_solution
+import gc
+from time import time
+from dataclasses import dataclass
+import pickle
+import weakref
+import shutil
+import subprocess
+import sys
+import os
+import json
+import asyncio
+import pytest
 
 def test_solve_exact():
     assert None != solve(game1_1, approx=False, bits=8, no_overflow=False)
@@ -26,3 +53,389 @@ def test_solve_approx():
     m = solve(game2, approx=True, bits=14, no_overflow=True)
     assert solution_resulting_number(m) == game2.objective
 
+
+def test_solve_search():
+    assert None != solve(game1_1, approx=False, bits=8, no_overflow=False, backend="search")
+    assert None == solve(game1_2, approx=False, bits=14, no_overflow=False, backend="search")
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True, backend="search")
+    assert solution_resulting_number(m) == 120
+    for game in [game2, game3_1, game3_2, game4]:
+        m = solve(game, approx=False, bits=14, no_overflow=True, backend="search")
+        assert solution_resulting_number(m) == game.objective
+
+def test_search_matches_smt():
+    # Même sémantique que l'encodage Z3, dépassements compris
+    for game, bits in [(GameInput(numbers=[3, 5, 6], objective=2), 3),
+                       (GameInput(numbers=[7, 6, 2], objective=5), 4),
+                       (game1_2, 7)]:
+        for approx in (False, True):
+            for no_overflow in (False, True):
+                smt = solve(game, approx=approx, bits=bits, no_overflow=no_overflow)
+                search = solve(game, approx=approx, bits=bits, no_overflow=no_overflow,
+                               backend="search")
+                assert (smt is None) == (search is None)
+                if smt is not None:
+                    assert smt.difference == search.difference
+                    assert len(list(smt.actions_effectuees())) == len(search.actions)
+
+def test_solve_many():
+    results = sorted(solve_many([game1_1, game1_2, game4], approx=False, bits=10,
+                                no_overflow=True, workers=2), key=lambda r: r.index)
+    assert [r.error for r in results] == [None, None, None]
+    assert results[0].solution.resulting_number() == game1_1.objective
+    assert results[1].solution is None
+    assert results[2].solution.resulting_number() == game4.objective
+    # un jeu trop long est reporté en erreur sans bloquer le lot
+    [result] = solve_many([game3_2], approx=True, bits=10, no_overflow=True, workers=1,
+                          timeout=0.5)
+    assert result.error.startswith("TimeoutError")
+
+@dataclass(frozen=True)
+class Crashing(Configuration):
+    def mk_solver(self):
+        os._exit(1)
+
+def test_solve_portfolio():
+    configurations = [Configuration("z3"), Configuration("z3-seed", solver_params=(("random_seed", 7),)),
+                      Configuration("z3-wide", extra_bits=4)]
+    solution, winner = solve_portfolio(game1_1, approx=False, bits=8, no_overflow=True,
+                                       configurations=configurations)
+    assert solution.resulting_number() == game1_1.objective
+    assert winner in {"z3", "z3-seed", "z3-wide"}
+    assert (None, ) == solve_portfolio(game1_2, approx=False, bits=8, no_overflow=True,
+                                       configurations=configurations)[:1]
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True, backend="portfolio")
+    assert solution_resulting_number(m) == 120
+    # un processus arrêté sans réponse compte comme une erreur, sans bloquer l'attente
+    with pytest.raises(AssertionError, match="crash: processus arrêté"):
+        solve_portfolio(game1_1, approx=False, bits=8, no_overflow=True,
+                        configurations=[Crashing("crash")])
+
+def test_solve_registers():
+    assert None != solve(game1_1, approx=False, bits=8, no_overflow=False, encoding="registers")
+    assert None == solve(game1_2, approx=False, bits=14, no_overflow=False, encoding="registers")
+    assert None != solve(game3_1, approx=False, bits=10, no_overflow=True, encoding="registers")
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True, encoding="registers")
+    assert solution_resulting_number(m) == 120
+
+def test_solve_symmetry():
+    # les contraintes de symétrie ne changent pas les réponses
+    for encoding in ("array", "registers"):
+        assert None == solve(game1_2, approx=False, bits=14, no_overflow=True, encoding=encoding,
+                             symmetry=True)
+        for game in (game3_1, game3_2):
+            m = solve(game, approx=False, bits=10, no_overflow=True, encoding=encoding,
+                      symmetry=True)
+            assert solution_resulting_number(m) == game.objective
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True, encoding="registers", symmetry=True)
+    assert solution_resulting_number(m) == 120
+    # constantes en double et objectif nul : 0 n'est atteignable que par soustraction
+    game = GameInput(numbers=[7, 7, 1], objective=0)
+    assert None != solve(game, approx=False, bits=5, no_overflow=True, symmetry=True)
+    assert 0 == solve(game, approx=True, bits=5, no_overflow=True, symmetry=True).difference
+
+def test_solve_single():
+    assert None != solve(game1_1, approx=False, bits=8, no_overflow=False, engine="single")
+    assert None == solve(game1_2, approx=False, bits=8, no_overflow=False, engine="single")
+    m = solve(game4, approx=False, bits=10, no_overflow=True, engine="single", encoding="registers")
+    assert solution_resulting_number(m) == game4.objective
+    # même longueur que le moteur incrémental (solution la plus courte)
+    assert len(list(m.actions_effectuees())) == 7
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True, engine="single", encoding="registers")
+    assert solution_resulting_number(m) == 120
+
+def test_solution_cache(tmp_path):
+    cache = SolutionCache(maxsize=2, path=str(tmp_path / "cache.sqlite"))
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True, cache=cache)
+    assert solution_resulting_number(m) == 120
+    # même instance, constantes dans un autre ordre : les indices sont renumérotés
+    shuffled = GameInput(numbers=[40, 10, 30, 20], objective=119)
+    m = solve(shuffled, approx=True, bits=14, no_overflow=True, cache=cache)
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    assert solution_resulting_number(m) == 120 and m.difference == 1
+    # les problèmes insatisfiables sont aussi mis en cache
+    assert None == solve(game1_2, approx=False, bits=14, no_overflow=True, cache=cache)
+    assert None == solve(shuffled, approx=False, bits=14, no_overflow=True, cache=cache)
+    assert cache.stats.hits == 2
+    solve(game1_1, approx=False, bits=14, no_overflow=True, backend="search", cache=cache)
+    assert len(cache) == 2 and cache.stats.evictions == 1
+    # les autres paramètres de solve sont transmis lorsque l'instance n'est pas en cache
+    interrupt, counters = Interrupt(), Counters()
+    interrupt.cancel()
+    with pytest.raises(Cancelled):
+        solve(game1_1, approx=False, bits=8, no_overflow=False, interrupt=interrupt, cache=cache)
+    solve(game1_1, approx=False, bits=8, no_overflow=False, counters=counters, cache=cache)
+    assert counters.checks > 0
+    cache.close()
+    # les entrées évincées de la mémoire restent sur disque
+    cache = SolutionCache(path=str(tmp_path / "cache.sqlite"))
+    assert cache.get(shuffled, approx=True, no_overflow=True, bits=14)[0]
+    assert cache.stats.disk_hits == 1
+
+def test_reachability_index(tmp_path):
+    path = str(tmp_path / "index.bin")
+    build_index(path, games=[[8, 10, 2, 1, 5, 50], [3, 3, 2, 2, 1, 1], [100, 75, 50, 9, 2, 1]],
+                workers=1, chunk_size=2)
+    index = ReachabilityIndex(path)
+    assert len(index) == 3
+    assert index.reachable(game4.numbers, game4.objective)
+    assert index.closest([1, 1, 2, 2, 3, 3], 100) == 81
+    assert not index.covers(game4.numbers, game4.objective, no_overflow=True, bits=10)
+    m = solve(game4, approx=False, bits=14, no_overflow=True, index=index, encoding="registers")
+    assert solution_resulting_number(m) == game4.objective
+    game = GameInput(numbers=[3, 3, 2, 2, 1, 1], objective=100)
+    assert None == solve(game, approx=False, bits=14, no_overflow=True, index=index)
+    game = GameInput(numbers=[100, 75, 50, 9, 2, 1], objective=203)
+    assert None == solve(game, approx=False, bits=14, no_overflow=True, index=index)
+    m = solve(game, approx=True, bits=14, no_overflow=True, index=index)
+    assert abs(solution_resulting_number(m).as_long() - 203) == 1 and m.difference == 1
+    index.close()
+
+def test_solve_iter():
+    solutions = list(solve_iter(game1_2, bits=14, no_overflow=True))
+    differences = [solution.difference for solution in solutions]
+    assert differences == sorted(set(differences), reverse=True)
+    assert solution_resulting_number(solutions[-1]) == 120
+    # un écart minimal connu arrête la recherche dès qu'il est atteint
+    solutions = list(solve_iter(game1_2, bits=14, no_overflow=True, lower_bound=100))
+    assert solutions[-1].difference <= 100
+    assert all(solution.difference > 100 for solution in solutions[:-1])
+    # à l'expiration du délai ou après une interruption le générateur s'arrête sans erreur
+    begin = time()
+    solutions = list(solve_iter(game4, bits=14, no_overflow=True, timeout=0.01))
+    assert time() - begin < 5
+    differences = [solution.difference for solution in solutions]
+    assert differences == sorted(differences, reverse=True)
+    interrupt = Interrupt()
+    interrupt.cancel()
+    assert [] == list(solve_iter(game4, bits=14, no_overflow=True, interrupt=interrupt))
+
+def test_solve_observer():
+    events, counters = [], Counters()
+    assert None == solve(game1_2, approx=False, bits=8, no_overflow=False,
+                         observer=events.append, counters=counters)
+    assert [event.depth for event in events] == [1, 3, 5, 7]
+    assert all(event.status == "unsat" and event.checks == 1 for event in events)
+    assert "conflicts" in events[-1].statistics and events[-1].assertions > 0
+    assert (counters.depths, counters.checks, counters.unsat, counters.sat) == (4, 4, 4, 0)
+    assert 0 < counters.check_time <= counters.total_time
+    events = []
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True, observer=events.append)
+    assert events[-1].best_score == m.difference == 1
+
+def test_reused_unrolling():
+    # même nombre de constantes que game1_1 : les formules des transitions sont réutilisées
+    # avec d'autres valeurs des constantes
+    assert None != solve(game1_1, approx=False, bits=8, no_overflow=False)
+    m = solve(GameInput(numbers=[1, 2, 3, 4], objective=24), approx=False, bits=8,
+              no_overflow=False)
+    assert solution_resulting_number(m) == 24
+    # ni la classe des états ni les actions ne sont reconstruites
+    State, actions, _ = transition_system(game1_1, False, False, 8)
+    assert State.func is transition_system(game1_2, False, False, 8)[0].func and actions is None
+    ctx = Context()
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True, ctx=ctx)
+    assert solution_resulting_number(m) == 120
+    # le dépliage gardé pour ce contexte est libéré avec lui
+    assert ctx.unrolling_templates
+    context = weakref.ref(ctx)
+    del ctx, m
+    gc.collect()
+    assert context() is None
+
+def test_solve_service():
+    async def requests():
+        service = SolveService(workers=2)
+        try:
+            # deux requêtes identiques en cours : une seule résolution
+            first, second = await asyncio.gather(
+                service.solve(game1_1, approx=False, bits=8, no_overflow=False),
+                service.solve(game1_1, approx=False, bits=8, no_overflow=False))
+            assert first is second and first.resulting_number() == 120
+            assert service.coalesced == 1
+            response = await handle(service, {"id": 7, "numbers": [10, 20, 30, 40],
+                                              "objective": 60, "bits": 8, "no_overflow": False})
+            assert (response["id"], response["status"], response["result"]) == (7, "sat", 60)
+            # la résolution est interrompue à l'expiration du délai
+            with pytest.raises(TimeoutError):
+                await service.solve(game4, approx=False, bits=14, no_overflow=True, timeout=0.2)
+            response = await handle(service, {"numbers": game4.numbers, "objective": 899,
+                                              "timeout": 0.2})
+            assert response["status"] == "timeout"
+            assert service.stats()["in_flight"] == 0
+        finally:
+            service.close()
+    asyncio.run(requests())
+
+def test_solve_cubes(monkeypatch):
+    # constantes égales : push_1 n'est jamais poussée avant push_0
+    assert cubes([1, 1, 2], 2) == [("push_0", "push_1"), ("push_0", "push_2"), ("push_2", "push_0")]
+    assert len(cubes(game3_1.numbers, 3)) == 12 * 11 * (10 + 4)
+    m = solve(game1_1, approx=False, bits=8, no_overflow=False, backend="cubes")
+    assert m.resulting_number() == 120 and len(m.actions) == 5
+    assert None == solve(game1_2, approx=False, bits=8, no_overflow=False, backend="cubes")
+    # un processus arrêté pendant la résolution d'un cube est une erreur
+    monkeypatch.setattr(cubes_module, "transition_system", lambda *arguments: os._exit(1))
+    with pytest.raises(AssertionError, match="Processus arrêté"):
+        solve(game1_1, approx=False, bits=8, no_overflow=False, backend="cubes")
+
+def test_solve_auto_bits():
+    assert (narrow_bits(game1_2), safe_bits(game1_2, False), safe_bits(game1_2, True)) == (8, 19, 20)
+    m = solve(game1_1, approx=False, bits="auto", no_overflow=True)
+    assert solution_resulting_number(m) == 120
+    # 9 * 40 / 60 : le résultat intermédiaire 360 n'est pas représentable sur 7 bits
+    game = GameInput(numbers=[9, 40, 60], objective=6)
+    assert None == solve(game, approx=False, bits=7, no_overflow=True)
+    m = solve(game, approx=False, bits="auto", no_overflow=True)
+    assert solution_resulting_number(m) == 6
+    m = solve(game1_2, approx=True, bits="auto", no_overflow=True)
+    assert solution_resulting_number(m) == 120 and m.difference == 1
+
+def test_presolve():
+    before = fired.copy()
+    # l'objectif est une constante : le backend smt garde son type de solution
+    game = GameInput(numbers=[5, 7], objective=7)
+    m = solve(game, approx=False, bits=8, no_overflow=True)
+    assert list(m.actions_effectuees()) == ["push_1"]
+    assert solution_resulting_number(m).as_long() == 7
+    m = solve(game, approx=False, bits=8, no_overflow=True, backend="search")
+    assert m.actions == ["push_1"] and solution_resulting_number(m) == 7
+    # 3 * 3 * 2 < 900 : pas de solution exacte, écart d'au moins 882
+    game = GameInput(numbers=[1, 2, 3], objective=900)
+    assert None == solve(game, approx=False, bits=14, no_overflow=True)
+    m = solve(game, approx=True, bits=14, no_overflow=True)
+    assert solution_resulting_number(m) == 9 and m.difference == 891
+    assert beam(game1_2.numbers, 119, True, 14)[0] == 1
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True)
+    assert solution_resulting_number(m) == 120 and m.difference == 1
+    # les autres backends n'utilisent pas la borne de la recherche en faisceau
+    m = solve(game1_2, approx=True, bits=14, no_overflow=True, backend="search")
+    assert m.difference == 1
+    assert fired - before == {"objective_tile": 1, "magnitude": 2, "beam": 2}
+
+def test_compact_solution():
+    m = solve(game1_1, approx=False, bits=8, no_overflow=False)
+    compact = portable_solution(m, game1_1, no_overflow=False, bits=8)
+    assert compact.actions == list(m.actions_effectuees())
+    assert compact.resulting_number() == solution_resulting_number(m) == 120
+    assert compact.stacks[0] == [] and compact.stacks[-1] == [120]
+    assert pickle.loads(pickle.dumps(compact)) == compact
+    # valeurs sur plus de 64 bits
+    big = SearchSolution(actions=["push_0"], stacks=[[], [1 << 70]], difference=3)
+    assert pickle.loads(pickle.dumps(big)).stacks == [[], [1 << 70]]
+
+def test_bmc_approx_bisect():
+    State, actions, unrolling = transition_system(game1_2, True, True, 14)
+    results = []
+    for bisect in (False, True):
+        events = []
+        m = bmc_approx(State, actions, init_predicate,
+                       partial(final_state_approx_constraints, game1_2.objective), 7,
+                       candidate_depth=odd_depth, observer=events.append, unrolling=unrolling,
+                       bisect=bisect)
+        results.append((m.difference, len(m.transitions)))
+        # la dernière profondeur ne peut pas améliorer l'écart trouvé
+        assert events[-1].status == "unsat" and events[-1].best_score == 1
+    assert results == [(1, 5), (1, 5)]
+
+def test_solve_targets():
+    numbers = [3, 5, 7]
+    # avec dépassements, l'écart est pris modulo 2^bits (127 : 1 à un écart de 2)
+    for objectives, no_overflow, bits, approxs in ((list(range(40)), True, 8, (False, True)),
+                                                   ([0, 60, 120, 127], False, 7, (True,))):
+        for approx in approxs:
+            solutions = solve_targets(numbers, objectives, approx=approx,
+                                      no_overflow=no_overflow, bits=bits)
+            assert sorted(solutions) == objectives
+            for objective, m in solutions.items():
+                expected = solve(GameInput(numbers, objective), approx=approx, bits=bits,
+                                 no_overflow=no_overflow, backend="search")
+                if expected is None:
+                    assert m is None
+                    continue
+                # même écart et même longueur que la recherche exhaustive
+                assert (m.difference, len(m.transitions)) == (expected.difference,
+                                                              len(expected.actions))
+                value = solution_resulting_number(m).as_long()
+                assert distance(value, objective, bits) == m.difference
+    assert solutions[127].difference == 2
+    # aucun écart n'est représentable (0 et 2 sur 2 bits) : pas de solution, comme solve
+    assert solve_targets([0], [2], approx=True, no_overflow=True, bits=2) == {2: None}
+
+def test_solve_all():
+    # (a + b) + c et c + (b + a) ont la même forme canonique
+    assert canonical_expression([3, 5, 7], ["push_0", "push_1", "add", "push_2", "add"]) == \
+        canonical_expression([3, 5, 7], ["push_2", "push_1", "push_0", "add", "add"])
+    game = GameInput(numbers=[3, 5, 7], objective=15)
+    for symmetry in (True, False):
+        # 3 * 5 et 3 + 5 + 7, parmi 14 traces
+        solutions = list(solve_all(game, approx=False, no_overflow=True, bits=8,
+                                   symmetry=symmetry))
+        assert [len(m.transitions) for m in solutions] == [3, 5]
+        assert all(solution_resulting_number(m) == 15 for m in solutions)
+    assert len(list(solve_all(game, approx=False, no_overflow=True, bits=8, limit=1))) == 1
+    # 6 * (3 - 2) et 6 / (3 - 2) sont des expressions distinctes, même avec symmetry
+    for symmetry in (True, False):
+        expressions = [canonical_expression([2, 3, 6], list(m.actions_effectuees()))
+                       for m in solve_all(GameInput(numbers=[2, 3, 6], objective=6),
+                                          approx=False, no_overflow=True, bits=8,
+                                          symmetry=symmetry)]
+        assert len(expressions) == 6
+        assert ("div", 6, ("sub", 3, 2)) in expressions
+        assert ("mult", ("sub", 3, 2), 6) in expressions
+    # écart optimal 1 : 12 (5 + 7) puis 14 (7 * (5 - 3))
+    solutions = list(solve_all(GameInput(numbers=[3, 5, 7], objective=13), approx=True,
+                               no_overflow=True, bits=8))
+    assert [(solution_resulting_number(m), m.difference) for m in solutions] == [(12, 1), (14, 1)]
+    assert [] == list(solve_all(GameInput(numbers=[0], objective=2), approx=True,
+                                no_overflow=True, bits=2))
+
+@pytest.mark.skipif(shutil.which("z3") is None, reason="exécutable z3 absent")
+def test_export(tmp_path):
+    for format, command, path in (("smt2", ["z3"], tmp_path / "game.smt2"),
+                                  ("dimacs", ["z3", "-dimacs"], tmp_path / "game.cnf")):
+        for game, depth in ((game1_1, 5), (game1_2, 5)):
+            export(game, False, True, 14, depth, str(path), format, encoding="registers")
+            m = run_solver(command, str(path), game, False, True, 14, depth)
+            # bmc trouve une solution de longueur 5 pour game1_1, aucune pour game1_2
+            assert (m is None) == (game is game1_2)
+            if m is not None:
+                assert m.resulting_number() == game.objective and len(m.actions) == depth
+    with pytest.raises(ValueError):
+        export(game1_1, False, True, 14, 5, str(tmp_path / "game.cnf"), "dimacs")
+
+def test_cli(tmp_path):
+    def run(*arguments, stdin=""):
+        # depuis le répertoire parent : le paquet doit trouver ses propres modules
+        completed = subprocess.run(
+            [sys.executable, "-m", "projet_clauverj_sthoby", "--timings", *arguments],
+            input=stdin, capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        return [json.loads(line) for line in completed.stdout.splitlines()], completed.stderr
+
+    # la recherche directe et les filtres répondent sans importer Z3
+    responses, timings = run("-o", "899", "8", "10", "2", "1", "5", "50", "--backend", "search")
+    assert responses[0]["status"] == "sat" and responses[0]["result"] == 899
+    assert "non importés" in timings
+    requests = [{"id": 1, "numbers": [1, 2, 3], "objective": 900},
+                {"id": 2, "numbers": [3, 5, 7], "objective": 13, "approx": True}]
+    responses, timings = run(stdin="".join(json.dumps(request) + "\n" for request in requests))
+    assert [(response["id"], response["status"]) for response in responses] == [(1, "unsat"),
+                                                                                 (2, "sat")]
+    assert responses[1]["difference"] == 1 and "non importés" not in timings
+    # --bits auto sur le backend smt, puis depuis le cache
+    for hit in (False, True):
+        responses, timings = run("-o", "120", "10", "20", "30", "40", "--bits", "auto",
+                                 "--cache", str(tmp_path / "cache.sqlite"))
+        assert responses[0]["status"] == "sat" and responses[0]["result"] == 120
+        assert ("non importés" in timings) == hit
+    # comme pour service.py, une ligne invalide n'arrête pas les suivantes
+    responses, _ = run(stdin='{"numbers": [1,\n' + json.dumps(requests[1]) + "\n")
+    assert [response["status"] for response in responses] == ["error", "sat"]
+    # importer le paquet ne modifie pas sys.path
+    completed = subprocess.run(
+        [sys.executable, "-c", "import os, sys, projet_clauverj_sthoby as package; "
+                               "print(os.path.dirname(package.__file__) in sys.path)"],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert completed.stdout.strip() == "False"